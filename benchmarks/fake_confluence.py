@@ -0,0 +1,199 @@
+"""
+An in-memory fake of the parts of the Confluence REST API used by mdformatter, so that
+the full pipeline can be benchmarked, and the Confluence API tested, without a
+Confluence instance.
+"""
+
+import contextlib
+import json
+import re
+import threading
+import time
+
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from requests.adapters import BaseAdapter
+from requests.models import PreparedRequest, Response
+
+DOMAIN = "benchmark.atlassian.net"
+PATH = "/wiki/"
+SPACE = "BENCH"
+ROOT_PAGE = "Benchmark Root"
+
+
+class FakeConfluence(BaseAdapter):
+    """
+    A requests transport adapter that serves the requests sent to the Confluence REST
+    API from memory. Each request is delayed by `latency` seconds, to simulate the
+    network round trip, and the largest number of requests in flight at once is
+    recorded (`max_active`). Page listings return at most `batch_size` pages, even if
+    more are requested.
+    """
+
+    def __init__(
+        self,
+        root_page: str = ROOT_PAGE,
+        latency: float = 0.0,
+        batch_size: Optional[int] = None,
+    ) -> None:
+        super().__init__()
+        self.root_page = root_page
+        self.latency = latency
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        # (method, path, query) of each request
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self.active = self.max_active = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """
+        Deletes all the pages but the root page, and their attachments.
+        """
+        self.pages = {}
+        self.attachments = {}  # (page id, file name) -> attachment
+        self.next_id = 1
+        self.add_page(self.root_page)
+
+    def add_page(self, title: str, parent_id: Optional[str] = None) -> str:
+        """
+        Adds an empty page with the given title, after the other children of its
+        parent (if any), and returns its id.
+        """
+        id = str(self.next_id)
+        self.next_id += 1
+        self.pages[id] = {"title": title, "body": "", "version": 1, "children": []}
+        if parent_id is not None:
+            self.pages[parent_id]["children"].append(id)
+        return id
+
+    def send(self, request: PreparedRequest, **kwargs) -> Response:
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        if self.latency:
+            time.sleep(self.latency)
+        url = urlparse(request.url)
+        path = url.path.split("/rest/api", 1)[1]
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with self.lock:
+            self.active -= 1
+            self.requests.append((request.method, path, query))
+            status, data = self._handle(request, path, query)
+
+        response = Response()
+        response.status_code = status
+        response.request = request
+        response.url = request.url
+        response.headers["Content-Type"] = "application/json"
+        response._content = json.dumps(data).encode()
+        return response
+
+    def close(self) -> None:
+        pass
+
+    def _handle(self, request: PreparedRequest, path: str, query: Dict[str, str]):
+        if path == "/content" and request.method == "GET":
+            pages = [
+                {"id": id, "title": page["title"]}
+                for id, page in self.pages.items()
+                if query.get("title", page["title"]) == page["title"]
+            ]
+            start, limit = int(query.get("start", 0)), int(query.get("limit", 25))
+            end = start + min(limit, self.batch_size or limit)
+            links = {"next": "..."} if end < len(pages) else {}
+            return 200, {"results": pages[start:end], "_links": links}
+
+        if path == "/content" and request.method == "POST":
+            data = json.loads(request.body)
+            if data["ancestors"][0]["id"] not in self.pages:
+                return 400, {"message": "The parent page does not exist"}
+            id = self.add_page(data["title"], data["ancestors"][0]["id"])
+            return 200, {"id": id, "title": data["title"]}
+
+        match = re.fullmatch(r"/content/(\d+)/move/after/(\d+)", path)
+        if match and request.method == "PUT":
+            id, target_id = match.groups()
+            for page in self.pages.values():
+                if target_id in page["children"]:
+                    if id in page["children"]:
+                        page["children"].remove(id)
+                        index = page["children"].index(target_id) + 1
+                        page["children"].insert(index, id)
+                        return 200, {"pageId": id}
+            return 400, {"message": "The pages are not siblings"}
+
+        match = re.fullmatch(r"/content/(\d+)", path)
+        if match and request.method == "GET":
+            page = self.pages[match.group(1)]
+            return 200, {
+                "id": match.group(1),
+                "title": page["title"],
+                "version": {"number": page["version"]},
+                "body": {"storage": {"value": page["body"]}},
+            }
+        if match and request.method == "PUT":
+            data = json.loads(request.body)
+            page = self.pages[match.group(1)]
+            page["body"] = data["body"]["storage"]["value"]
+            page["version"] = data["version"]["number"]
+            return 200, {}
+
+        match = re.fullmatch(r"/content/(\d+)/child/attachment", path)
+        if match and request.method == "GET":
+            attachment = self.attachments.get((match.group(1), query.get("filename")))
+            return 200, {"results": [attachment] if attachment else []}
+
+        # The name of an uploaded attachment is truncated to its base name, and then
+        # restored by renaming it
+        match = re.fullmatch(r"/content/(\d+)/child/attachment/(\d+)", path)
+        if match and request.method == "PUT":
+            data = json.loads(request.body)
+            for (page_id, name), attachment in list(self.attachments.items()):
+                if page_id == match.group(1) and attachment["id"] == data["id"]:
+                    del self.attachments[(page_id, name)]
+                    self.attachments[(page_id, data["title"])] = attachment
+            return 200, {}
+
+        match = re.fullmatch(r"/content/(\d+)/child/attachment(?:/(\d+)/data)?", path)
+        if match and request.method == "POST":
+            body = request.body if isinstance(request.body, bytes) else b""
+            name = re.search(rb'filename="([^"]+)"', body).group(1).decode()
+            comment = re.search(rb'name="comment"\r\n\r\n([^\r]*)', body)
+            attachment = {
+                "id": f"att{match.group(2) or self.next_id}",
+                "version": {"number": 1},
+                "extensions": {
+                    "mediaType": "application/octet-stream",
+                    "fileSize": len(body),
+                    "comment": comment.group(1).decode() if comment else "",
+                },
+            }
+            self.next_id += 1
+            self.attachments[(match.group(1), name)] = attachment
+            return 200, {"results": [attachment]}
+
+        return 404, {"message": f"Not found: {request.method} {path}"}
+
+
+@contextlib.contextmanager
+def serve(fake: FakeConfluence, domain: str = DOMAIN) -> Iterator[FakeConfluence]:
+    """
+    Routes the requests sent to the given domain by any requests session to the fake,
+    for the duration of the context.
+    """
+    get_adapter = requests.Session.get_adapter
+
+    def get_fake_adapter(session, url):
+        if urlparse(url).hostname == domain:
+            return fake
+        return get_adapter(session, url)
+
+    requests.Session.get_adapter = get_fake_adapter
+    try:
+        yield fake
+    finally:
+        requests.Session.get_adapter = get_adapter
@@ -0,0 +1,226 @@
+"""
+Generates a synthetic documentation tree (templates, overrides and a values file) of a
+configurable size, in the same format as the `sample` folder.
+
+Usage: python -m benchmarks.generate OUTPUT_DIR [--files N] [--depth N] ...
+"""
+
+import argparse
+import json
+import os
+import random
+
+from typing import Dict
+
+# Number of pages per directory; the first page of each directory is the parent of the
+# other pages in it.
+PAGES_PER_DIRECTORY = 10
+# Number of directories whose first page is a child of the first page of another one
+DIRECTORIES_PER_DIRECTORY = 4
+
+# Number of images shared by all the pages, and their size in bytes
+SHARED_IMAGES = 5
+IMAGE_SIZE = 20_000
+
+LOREM = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod."
+
+
+def generate_tree(
+    root,
+    files: int = 100,
+    depth: int = 3,
+    override_ratio: float = 0.3,
+    variable_density: float = 0.2,
+    pageref_fanout: int = 2,
+    images: int = 1,
+    section_lines: int = 8,
+    seed: int = 0,
+) -> Dict[str, str]:
+    """
+    Writes a documentation tree under the given folder and returns the paths of its
+    `templates_dir`, `overrides_dir` and `values_file`. The images are written to the
+    `assets` folder, so the results must be written next to the templates (eg: to a
+    `results` folder) for the links to the images to work.
+
+    Parameters
+    ----------
+    root: str
+        Path to the folder where the tree should be written
+    files: int, default 100
+        Number of templates
+    depth: int, default 3
+        Maximum heading level of the sections of each template
+    override_ratio: float, default 0.3
+        Fraction of the templates that have an override
+    variable_density: float, default 0.2
+        Probability of a line of text containing a template variable
+    pageref_fanout: int, default 2
+        Number of `page-ref` tags in each template, to other templates
+    images: int, default 1
+        Number of images in each template, out of the images shared by all the
+        templates. The first one is referenced twice.
+    section_lines: int, default 8
+        Number of lines of text in each section
+    seed: int, default 0
+        Seed of the random number generator, so that trees can be reproduced
+    """
+    rng = random.Random(seed)
+    templates_dir = os.path.join(root, "templates")
+    overrides_dir = os.path.join(root, "overrides")
+    values_file = os.path.join(root, "values.json")
+
+    paths = [_page_path(i) for i in range(files)]
+    variables = [f"variable_{i}" for i in range(max(1, files // 2))]
+
+    image_paths = []
+    for i in range(SHARED_IMAGES):
+        image_paths.append(os.path.join(root, "assets", f"image_{i}.png"))
+        os.makedirs(os.path.dirname(image_paths[-1]), exist_ok=True)
+        with open(image_paths[-1], "wb") as f:
+            f.write(rng.randbytes(IMAGE_SIZE))
+
+    for i, path in enumerate(paths):
+        page_refs = [
+            os.path.relpath(paths[j], os.path.dirname(path))
+            for j in rng.sample(range(files), min(pageref_fanout, files))
+        ]
+        page_images = [
+            os.path.relpath(
+                image_path, os.path.dirname(os.path.join(templates_dir, path))
+            )
+            for image_path in rng.sample(image_paths, min(images, SHARED_IMAGES))
+        ]
+        template = _generate_page(
+            rng,
+            i,
+            depth,
+            section_lines,
+            variables,
+            variable_density,
+            page_refs,
+            page_images[:1] + page_images,
+        )
+        _write(os.path.join(templates_dir, path), template)
+
+        if rng.random() < override_ratio:
+            _write(
+                os.path.join(overrides_dir, path),
+                _generate_override(i, section_lines),
+            )
+    os.makedirs(overrides_dir, exist_ok=True)
+
+    with open(values_file, "w") as f:
+        json.dump({name: f"value of {name}" for name in variables}, f)
+
+    return {
+        "templates_dir": templates_dir,
+        "overrides_dir": overrides_dir,
+        "values_file": values_file,
+    }
+
+
+def _page_path(i: int) -> str:
+    # Directories are nested so that the page tree has several levels
+    directory = i // PAGES_PER_DIRECTORY
+    parts = []
+    while directory > 0:
+        parts.append(f"section_{directory}")
+        directory = (directory - 1) // DIRECTORIES_PER_DIRECTORY
+    return os.path.join(*reversed(parts), f"page_{i}.md")
+
+
+def _parent_page(i: int):
+    # The first page of a directory is the child of the first page of its parent
+    # directory (or of the root page); the other pages are its children.
+    directory, page = divmod(i, PAGES_PER_DIRECTORY)
+    if page > 0:
+        return directory * PAGES_PER_DIRECTORY
+    if directory > 0:
+        return (directory - 1) // DIRECTORIES_PER_DIRECTORY * PAGES_PER_DIRECTORY
+    return None
+
+
+def _generate_page(
+    rng: random.Random,
+    i: int,
+    depth: int,
+    section_lines: int,
+    variables,
+    variable_density: float,
+    page_refs,
+    images,
+) -> str:
+    lines = [f"<!-- page-title: Page {i} -->"]
+    parent = _parent_page(i)
+    if parent is not None:
+        lines.append(f"<!-- parent-page-title: Page {parent} -->")
+
+    def add_section(level: int, name: str):
+        lines.append(f"{'#' * level} {name}")
+        lines.append("")
+        for _ in range(section_lines):
+            if rng.random() < variable_density:
+                lines.append(f"{LOREM} {{{{ {rng.choice(variables)} }}}}.")
+            else:
+                lines.append(LOREM)
+        lines.append("")
+        if level < depth:
+            for child in range(2):
+                add_section(level + 1, f"{name}.{child}")
+
+    add_section(1, f"Page {i}")
+    for image in images:
+        lines.append(f"![]({image})")
+        lines.append("")
+    lines.append('{% hint style="info" %}')
+    lines.append(LOREM)
+    lines.append("{% endhint %}")
+    lines.append("")
+    lines.append("## Related Pages")
+    lines.append("")
+    for page_ref in page_refs:
+        lines.append(f'{{% page-ref page="{page_ref}" %}}')
+    return "\n".join(lines)
+
+
+def _generate_override(i: int, section_lines: int) -> str:
+    # Overrides the contents of the first subsection of the page and adds a section
+    lines = [f"# Page {i}", "", f"## Page {i}.0", ""]
+    lines.extend(["Overridden. " + LOREM] * section_lines)
+    lines.extend(["", "## Extra Section", "", LOREM])
+    return "\n".join(lines)
+
+
+def _write(path: str, text: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output_dir", help="Path to the folder to generate.")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--override-ratio", type=float, default=0.3)
+    parser.add_argument("--variable-density", type=float, default=0.2)
+    parser.add_argument("--pageref-fanout", type=int, default=2)
+    parser.add_argument("--images", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    paths = generate_tree(
+        args.output_dir,
+        files=args.files,
+        depth=args.depth,
+        override_ratio=args.override_ratio,
+        variable_density=args.variable_density,
+        pageref_fanout=args.pageref_fanout,
+        images=args.images,
+        seed=args.seed,
+    )
+    print(json.dumps(paths, indent=2))
+
+
+if __name__ == "__main__":
+    main()
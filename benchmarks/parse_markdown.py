@@ -0,0 +1,55 @@
+"""
+Measures how the time taken to parse a markdown document scales with its size.
+
+Usage: python -m benchmarks.parse_markdown
+"""
+
+import math
+import random
+import timeit
+
+from mdformatter.merge import merge_markdowns, parse_markdown
+
+SIZES = [12_500, 25_000, 50_000, 100_000]  # Number of lines
+REPEAT = 3
+
+
+def generate_markdown(num_lines: int, seed: int = 0) -> str:
+    """
+    Returns a markdown document with the given number of lines, made of nested
+    sections with paragraphs and fenced code blocks containing shell comments.
+    """
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < num_lines:
+        choice = rng.random()
+        if choice < 0.1:
+            lines.append("#" * rng.randint(1, 4) + f" Heading {len(lines)}")
+        elif choice < 0.15:
+            lines.extend(["```sh", "# Install the package", "pip install x", "```"])
+        else:
+            lines.append("Lorem ipsum dolor sit amet, consectetur adipiscing elit.")
+    return "\n".join(lines[:num_lines])
+
+
+def main():
+    timings = []
+    print(f"{'lines':>10} {'parse (s)':>10} {'merge (s)':>10} {'us/line':>8}")
+    for size in SIZES:
+        text = generate_markdown(size)
+        parse = min(
+            timeit.repeat(lambda: parse_markdown(text), number=1, repeat=REPEAT)
+        )
+        merge = min(
+            timeit.repeat(lambda: merge_markdowns(text, text), number=1, repeat=REPEAT)
+        )
+        timings.append(parse)
+        print(f"{size:>10} {parse:>10.4f} {merge:>10.4f} {parse / size * 1e6:>8.3f}")
+
+    # Slope of the log-log plot of time vs size: 1 for linear scaling
+    slope = math.log(timings[-1] / timings[0]) / math.log(SIZES[-1] / SIZES[0])
+    print(f"Scaling exponent: {slope:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures how the time taken to prepare tag-dense markdown documents for Jinja (see
+`prepare_text`) scales with their size, compared with its previous regular
+expressions, which did not recognize the Gitbook tags with a "%" in their quoted
+arguments.
+
+Usage: python -m benchmarks.preprocess_tags
+"""
+
+import math
+import random
+import re
+import timeit
+
+from mdformatter.substitute import OutputFormat, prepare_text
+
+SIZES = [12_500, 25_000, 50_000, 100_000]  # Number of lines
+REPEAT = 3
+
+# The previous implementation of `prepare_text`, for each output format
+PREVIOUS_PREPARE = {
+    OutputFormat.GITBOOK: lambda text: re.sub(
+        r"({\% [^%]+ \%})", r"{% raw %}\g<0>{% endraw %}", text
+    ),
+    OutputFormat.CONFLUENCE: lambda text: re.sub(
+        r"{\% ([a-z]*)-([a-z]*)", r"{% \1\2", text
+    ),
+}
+
+
+def generate_markdown(num_lines: int, seed: int = 0) -> str:
+    """
+    Returns a markdown document with the given number of lines, about half of which
+    contain a Gitbook tag (hints, tabs, page references and embeds), and a third of
+    which contain a variable.
+    """
+    rng = random.Random(seed)
+    lines = []
+    while len(lines) < num_lines:
+        choice = rng.random()
+        if choice < 0.1:
+            lines.extend(['{% hint style="info" %}', "Note.", "{% endhint %}"])
+        elif choice < 0.2:
+            lines.extend(["{% tabs %}", '{% tab title="Python" %}', "{% endtab %}"])
+            lines.append("{% endtabs %}")
+        elif choice < 0.3:
+            lines.append(f'{{% page-ref page="page_{len(lines)}.md" %}}')
+        elif choice < 0.35:
+            lines.append('{% embed url="https://example.com/a%20b" %}')
+        elif choice < 0.7:
+            lines.append("Lorem ipsum dolor sit amet, {{ variable }} adipiscing elit.")
+        else:
+            lines.append("Lorem ipsum dolor sit amet, consectetur adipiscing elit.")
+    return "\n".join(lines[:num_lines])
+
+
+def main():
+    timings = []
+    print(
+        f"{'lines':>10} {'format':>10} {'current (s)':>11} {'previous (s)':>12}"
+        f" {'us/line':>8}"
+    )
+    for size in SIZES:
+        text = generate_markdown(size)
+        for output_format, previous_prepare in PREVIOUS_PREPARE.items():
+            current = min(
+                timeit.repeat(
+                    lambda: prepare_text(text, output_format), number=1, repeat=REPEAT
+                )
+            )
+            previous = min(
+                timeit.repeat(lambda: previous_prepare(text), number=1, repeat=REPEAT)
+            )
+            if output_format == OutputFormat.GITBOOK:
+                timings.append(current)
+            print(
+                f"{size:>10} {output_format.value:>10} {current:>11.4f}"
+                f" {previous:>12.4f} {current / size * 1e6:>8.3f}"
+            )
+
+    # Slope of the log-log plot of time vs size: 1 for linear scaling
+    slope = math.log(timings[-1] / timings[0]) / math.log(SIZES[-1] / SIZES[0])
+    print(f"Scaling exponent (gitbook): {slope:.2f}")
+
+
+if __name__ == "__main__":
+    main()
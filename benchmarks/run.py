@@ -0,0 +1,320 @@
+"""
+Benchmarks each stage of mdformatter, and the full pipeline, on a generated
+documentation tree (see `benchmarks.generate`). Confluence is replaced by an in-memory
+fake (see `benchmarks.fake_confluence`).
+
+The results are printed as a table and can be saved as JSON, to be compared with the
+results of another commit.
+
+Usage: python -m benchmarks.run [--files N] ... [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional
+
+from mdformatter import __version__
+from mdformatter.confluence.api import (
+    parse_page_title,
+    parse_parent_page_title,
+    preprocess,
+)
+from mdformatter.confluence.doctree import Node, build_tree
+from mdformatter.pipeline import load_documents
+from mdformatter.substitute import OutputFormat, substitute_documents
+
+from .fake_confluence import DOMAIN, PATH, ROOT_PAGE, SPACE, FakeConfluence, serve
+from .generate import generate_tree
+
+ADDITIONAL_CONTEXT = {
+    "confluence_domain": DOMAIN,
+    "confluence_path": PATH,
+    "confluence_space": SPACE,
+}
+
+
+def measure(
+    func: Callable[[object], object],
+    repeat: int,
+    setup: Optional[Callable[[], object]] = None,
+) -> Dict:
+    """
+    Calls `func` `repeat` times and returns the timings, in seconds. If `setup` is
+    given, it is called (untimed) before each call and its result is passed to `func`.
+    """
+    times = []
+    for _ in range(repeat):
+        argument = setup() if setup is not None else None
+        start = time.perf_counter()
+        func(argument)
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times), "times": times}
+
+
+def run_benchmarks(tree: Dict[str, str], work_dir, repeat: int, jobs: int) -> Dict:
+    """
+    Runs all the benchmarks on the given tree (see `generate_tree`) and returns their
+    timings, by name. Temporary outputs are written under the work directory.
+    """
+    with open(tree["values_file"]) as f:
+        values = json.load(f)
+    templates_dir, overrides_dir = tree["templates_dir"], tree["overrides_dir"]
+    results = {}
+
+    # Stages
+    results["merge"] = measure(
+        lambda _: load_documents(templates_dir, overrides_dir, jobs=jobs), repeat
+    )
+    documents = load_documents(templates_dir, overrides_dir)
+
+    results["substitute_gitbook"] = measure(
+        lambda _: substitute_documents(
+            documents, values, OutputFormat.GITBOOK, ADDITIONAL_CONTEXT, jobs=jobs
+        ),
+        repeat,
+    )
+
+    nodes = [Node(id=ROOT_PAGE, parent_id=None, rank=0)] + [
+        Node(
+            id=parse_page_title(text),
+            parent_id=parse_parent_page_title(text) or ROOT_PAGE,
+            rank=rank,
+        )
+        for rank, text in enumerate(documents.values())
+    ]
+    results["build_tree"] = measure(lambda _: build_tree(nodes), repeat)
+
+    def preprocess_documents(_=None):
+        return preprocess(
+            documents,
+            confluence_domain=DOMAIN,
+            confluence_path=PATH,
+            confluence_space=SPACE,
+            confluence_username="benchmark",
+            confluence_apikey="benchmark",
+            confluence_rootpage=ROOT_PAGE,
+        )
+
+    with serve(FakeConfluence()) as fake:
+        # Creating all the pages, and then finding them all
+        results["preprocess_create"] = measure(
+            preprocess_documents, repeat, setup=fake.reset
+        )
+        results["preprocess"] = measure(preprocess_documents, repeat)
+        preprocessed = preprocess_documents()
+
+    results["substitute_confluence"] = measure(
+        lambda _: substitute_documents(
+            preprocessed,
+            values,
+            OutputFormat.CONFLUENCE,
+            ADDITIONAL_CONTEXT,
+            jobs=jobs,
+        ),
+        repeat,
+    )
+
+    # Full pipeline, from scratch and then again with nothing to do
+    for output_format in (OutputFormat.GITBOOK, OutputFormat.CONFLUENCE):
+        name = f"pipeline_{output_format.value}"
+        run_dirs = []
+
+        def new_run_dir():
+            # Each run from scratch gets its own results and cache folders
+            run_dirs.append(os.path.join(work_dir, f"{name}_{len(run_dirs)}"))
+            fake.reset()
+            return run_dirs[-1]
+
+        with serve(FakeConfluence()) as fake:
+            results[name] = measure(
+                lambda run_dir: run_pipeline(tree, run_dir, output_format, jobs),
+                repeat,
+                setup=new_run_dir,
+            )
+            requests = len(fake.requests)
+            results[f"{name}_incremental"] = measure(
+                lambda _: run_pipeline(tree, run_dirs[-1], output_format, jobs),
+                repeat,
+            )
+            # Number of requests sent to Confluence per run
+            results[name]["requests"] = requests // repeat
+            results[f"{name}_incremental"]["requests"] = (
+                len(fake.requests) - requests
+            ) // repeat
+
+    # Startup, in a new interpreter: importing the package, and running the GITBOOK
+    # pipeline with nothing to do (eg: in a pre-commit hook)
+    results["startup_import"] = measure(
+        lambda _: subprocess.run(
+            [sys.executable, "-c", "import mdformatter"], check=True
+        ),
+        repeat,
+    )
+    argv = pipeline_args(
+        tree, os.path.join(work_dir, "pipeline_gitbook_0"), OutputFormat.GITBOOK, jobs
+    )
+    results["startup_gitbook_incremental"] = measure(
+        lambda _: subprocess.run(
+            [sys.executable, "-m", "mdformatter", *argv, "--loglevel=warning"],
+            check=True,
+        ),
+        repeat,
+    )
+
+    return results
+
+
+def run_pipeline(tree: Dict[str, str], run_dir, output_format: OutputFormat, jobs: int):
+    """
+    Runs `python -m mdformatter` on the given tree, in the current process, with its
+    cache under the given folder. The results are written next to the templates, named
+    after the folder.
+    """
+    original_argv = sys.argv
+    sys.argv = ["mdformatter"] + pipeline_args(tree, run_dir, output_format, jobs)
+    try:
+        runpy.run_module("mdformatter", run_name="__main__", alter_sys=True)
+    finally:
+        sys.argv = original_argv
+
+
+def pipeline_args(
+    tree: Dict[str, str], run_dir, output_format: OutputFormat, jobs: int
+) -> List[str]:
+    """
+    Returns the command line arguments of `python -m mdformatter` for `run_pipeline`.
+    """
+    argv = [
+        tree["templates_dir"],
+        tree["overrides_dir"],
+        os.path.join(
+            os.path.dirname(tree["templates_dir"]),
+            f"results_{os.path.basename(run_dir)}",
+        ),
+        tree["values_file"],
+        output_format.name,
+        f"--jobs={jobs}",
+        f"--cache-dir={os.path.join(run_dir, 'cache')}",
+    ]
+    if output_format == OutputFormat.CONFLUENCE:
+        argv += [
+            f"--domain={DOMAIN}",
+            f"--path={PATH}",
+            f"--space={SPACE}",
+            "--username=benchmark",
+            "--apikey=benchmark",
+            f"--rootpage={ROOT_PAGE}",
+        ]
+    return argv
+
+
+def environment() -> Dict:
+    """
+    Describes the environment of the benchmarks, to tell apart results to be compared.
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def print_results(results: Dict, baseline: Optional[Dict] = None) -> None:
+    header = f"{'benchmark':<34} {'min (s)':>10} {'median (s)':>11}"
+    if baseline is not None:
+        header += f" {'baseline (s)':>13} {'ratio':>7}"
+    print(header)
+    for name, result in results.items():
+        line = f"{name:<34} {result['min']:>10.4f} {result['median']:>11.4f}"
+        if baseline is not None and name in baseline:
+            line += f" {baseline[name]['min']:>13.4f}"
+            line += f" {result['min'] / baseline[name]['min']:>7.2f}"
+        print(line)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--override-ratio", type=float, default=0.3)
+    parser.add_argument("--variable-density", type=float, default=0.2)
+    parser.add_argument("--pageref-fanout", type=int, default=2)
+    parser.add_argument("--images", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--output", help="Path to the JSON file to save results to.")
+    parser.add_argument(
+        "--compare", help="Path to the JSON results of a previous run to compare to."
+    )
+    args = parser.parse_args(argv)
+
+    # Only report the warnings of the pipeline
+    logging.basicConfig(level=logging.WARNING)
+
+    parameters = {
+        "files": args.files,
+        "depth": args.depth,
+        "override_ratio": args.override_ratio,
+        "variable_density": args.variable_density,
+        "pageref_fanout": args.pageref_fanout,
+        "images": args.images,
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "jobs": args.jobs,
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        tree = generate_tree(
+            os.path.join(work_dir, "tree"),
+            files=args.files,
+            depth=args.depth,
+            override_ratio=args.override_ratio,
+            variable_density=args.variable_density,
+            pageref_fanout=args.pageref_fanout,
+            images=args.images,
+            seed=args.seed,
+        )
+        results = run_benchmarks(tree, work_dir, args.repeat, args.jobs)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            compared = json.load(f)
+        if compared["parameters"] != parameters:
+            logging.warning("The results to compare to used different parameters")
+        baseline = compared["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "environment": environment(),
+                    "parameters": parameters,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+__version__ = "0.1.0"
+
+from .builder import build, build_variants, check  # noqa: E402
@@ -2,29 +2,40 @@ import argparse
 import json
 import logging
 import os
+import sys
 import typing
 
-from pathlib import Path
+from . import profiling
+from .archives import is_archive
+from .builder import build, build_variants, check, load_manifest
+from .substitute import OutputFormat
+from .watch import watch
 
-from .confluence.api import preprocess, publish
-from .merge import merge_markdowns
-from .substitute import OutputFormat, substitute_variables
+FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 
 
-def parse_args(parser):
+def parse_args(parser, argv=None):
     parser.add_argument(
-        "templates_dir", help="Path to the Markdown templates root folder."
+        "templates_dir",
+        help="Path to the Markdown templates root folder, or a .tar, .tar.gz, .tgz or .zip "
+        "archive of it.",
     )
     parser.add_argument(
-        "overrides_dir", help="Path to the Markdown overrides root folder."
+        "overrides_dir",
+        help="Path to the Markdown overrides root folder, or an archive of it.",
     )
     parser.add_argument(
         "results_dir",
-        help="Path to the folder where the resulting markdowns should be stored.",
+        help="Path to the folder where the resulting markdowns should be stored, or to an "
+        "archive to store them in (GITBOOK only).",
     )
     parser.add_argument(
         "values_file",
-        help="Path to the values file to be applied to the variables in the Markdown templates.",
+        nargs="+",
+        help="Path to the values file to be applied to the variables in the Markdown "
+        "templates. Several values files, or folders of values files, can be given to "
+        "render the templates once per values file, to a subfolder of the results_dir "
+        "named after the values file (GITBOOK only).",
     )
     parser.add_argument(
         "output_format",
@@ -32,6 +43,24 @@ def parse_args(parser):
         default=OutputFormat.GITBOOK.name,
         help="Output format. One of {GITBOOK, CONFLUENCE}",
     )
+    parser.add_argument(
+        "-o",
+        "--override-dir",
+        action="append",
+        default=[],
+        help="Path to an additional Markdown overrides root folder or archive, applied "
+        "after the overrides_dir. Can be repeated; latter folders take precedence.",
+    )
+    parser.add_argument(
+        "--partials-dir",
+        action="append",
+        default=[],
+        help="Path to the folder or archive of the Markdown templates that the others "
+        'can include or import (eg: {%% include "support.md" %%}), which are not '
+        "rendered on their own, so it must not be inside the templates_dir. Can be "
+        "repeated to add override layers of the partials; latter folders take "
+        "precedence.",
+    )
     # Logging configurations
     parser.add_argument(
         "-l",
@@ -49,6 +78,45 @@ def parse_args(parser):
         default=logging.getLevelName(logging.INFO),
         help="Use this option to set the log verbosity.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of files to process in parallel.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-dir",
+        default=".mdformatter_cache",
+        help="Path to the folder where the build cache should be stored.",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Ignore the build cache and process and publish all the files.",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running and rebuild the affected files whenever the templates, the "
+        "overrides or the values file change.",
+    )
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Only check the merged templates, without rendering nor writing anything: "
+        "report the variables missing from the values file(s), the unknown tags and the "
+        "references to missing pages, and exit with status 1 if there are any.",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Save the timings of each stage and file, the Confluence requests and the "
+        "bytes read and written to the cache folder, as a JSON summary and a Chrome "
+        "trace.",
+    )
     # Confluence configurations
     parser.add_argument("-d", "--domain", help="Confluence organization domain.")
     parser.add_argument("-p", "--path", help="Base path for Confluece wiki.")
@@ -68,92 +136,225 @@ def parse_args(parser):
         "--rootpage",
         help="Confluence root page title under which the docs should be published.",
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of Confluence pages to create concurrently.",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="Maximum number of Confluence page creation requests per second.",
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        help="Maximum number of times a Confluence request is retried when throttled "
+        "or on a server error, with an exponential backoff.",
+    )
+    return parser.parse_args(argv)
 
 
-parser = argparse.ArgumentParser()
-args = parse_args(parser)
+def build_args(args) -> typing.Dict:
+    """
+    Returns the arguments of `build` given on the command line, other than the values.
+    """
+    return {
+        "templates_dir": args.templates_dir,
+        "overrides_dir": [args.overrides_dir] + args.override_dir,
+        "partials_dir": args.partials_dir or None,
+        "results_dir": args.results_dir,
+        "output_format": OutputFormat[args.output_format],
+        "jobs": args.jobs,
+        "cache_dir": args.cache_dir,
+    }
 
-FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
-logging.basicConfig(
-    format=FORMAT, level=getattr(logging, args.loglevel.upper(), logging.INFO)
-)
 
-if __name__ == "__main__":
-    # Init variables
-    templates_dir, overrides_dir, results_dir = (
-        args.templates_dir,
-        args.overrides_dir,
-        args.results_dir,
-    )
-    values_file = args.values_file
-    output_format = OutputFormat(OutputFormat[args.output_format].value)
+def confluence_args(args) -> typing.Dict:
+    """
+    Returns the Confluence arguments of `build` given on the command line.
+    """
+    return {
+        "confluence_domain": args.domain,
+        "confluence_path": args.path,
+        "confluence_space": args.space,
+        "confluence_username": args.username,
+        "confluence_apikey": args.apikey,
+        "confluence_rootpage": args.rootpage,
+        "confluence_workers": args.workers,
+        "confluence_rate_limit": args.rate_limit,
+        "confluence_max_retries": args.max_retries,
+    }
+
+
+def profiled_build(args, build_func, *build_args, **kwargs) -> None:
+    """
+    Runs the build function (eg: `build`) with the given arguments and, if profiling is
+    enabled, saves its profile to the cache folder.
+    """
+    if not args.profile:
+        build_func(*build_args, **kwargs)
+        return
+
+    with profiling.collector(profiling.Profiler()) as profiler:
+        with profiling.span("build"):
+            build_func(*build_args, **kwargs)
+    profile_dir = os.path.join(args.cache_dir, "profile")
+    profiler.save_summary(os.path.join(profile_dir, "summary.json"))
+    profiler.save_trace(os.path.join(profile_dir, "trace.json"))
+    for stage, timing in profiler.summary()["stages"].items():
+        logging.info(f"Stage {stage} took {timing['total']:.3f}s")
+    logging.info(f"Profile saved to {profile_dir}")
 
-    # Read values file
-    values = {}
+
+def read_values(values_file) -> typing.Dict:
     with open(values_file) as f:
-        values = json.load(f)
+        return json.load(f)
+
 
-    # Merge markdowns
-    logging.info("Merging markdowns ...")
-    for root, _dirs, files in os.walk(templates_dir):
+def list_values_files(paths: typing.List[str]) -> typing.Dict[str, str]:
+    """
+    Returns the given values files and the JSON files in the given folders, by the
+    name of their variant (i.e., their file name without the extension).
+    """
+    values_files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            files = [
+                os.path.join(path, file)
+                for file in sorted(os.listdir(path))
+                if file.endswith(".json")
+            ]
+        else:
+            files = [path]
         for file in files:
-            template_path = os.path.join(root, file)
-            logging.debug(f"Processing {template_path}")
+            name = os.path.splitext(os.path.basename(file))[0]
+            if name in values_files:
+                raise ValueError(
+                    f"Values files {values_files[name]} and {file} have the same name"
+                )
+            values_files[name] = file
+    return values_files
 
-            file_contents = ""
-            with open(template_path) as t:
-                file_contents = t.read()
 
-            # Merge the contents of the templates with the overrides
-            override_path = overrides_dir / Path(template_path).relative_to(
-                templates_dir
-            )
-            if os.path.exists(override_path):
-                logging.info(f"Applying override at {override_path}")
-                with open(override_path) as o:
-                    file_contents = merge_markdowns(file_contents, o.read())
-
-            # Output to the desired format
-            result_path = results_dir / Path(template_path).relative_to(templates_dir)
-            os.makedirs(os.path.dirname(result_path), exist_ok=True)
-            with open(result_path, "w") as f:
-                f.write(file_contents)
-
-    if output_format == OutputFormat.CONFLUENCE:
-        # Preprocess files
-        preprocess(
-            results_dir,
-            confluence_domain=args.domain,
-            confluence_path=args.path,
-            confluence_space=args.space,
-            confluence_username=args.username,
-            confluence_apikey=args.apikey,
-            confluence_rootpage=args.rootpage,
+def read_variants(values_files: typing.List[str]) -> typing.Dict[str, typing.Dict]:
+    """
+    Reads the values of every variant (see `list_values_files`), by name.
+    """
+    return {
+        name: read_values(values_file)
+        for name, values_file in list_values_files(values_files).items()
+    }
+
+
+def main(argv: typing.Optional[typing.List[str]] = None) -> None:
+    parser = argparse.ArgumentParser()
+    args = parse_args(parser, argv)
+
+    logging.basicConfig(
+        format=FORMAT, level=getattr(logging, args.loglevel.upper(), logging.INFO)
+    )
+
+    if args.output_format == OutputFormat.CONFLUENCE.name and is_archive(
+        args.results_dir
+    ):
+        parser.error("The CONFLUENCE output format requires a results folder")
+
+    if args.check:
+        problems = check(
+            args.templates_dir,
+            [args.overrides_dir] + args.override_dir,
+            read_variants(args.values_file),
+            OutputFormat[args.output_format],
+            jobs=args.jobs,
+            partials_dir=args.partials_dir or None,
         )
+        for problem in problems:
+            logging.error(problem)
+        logging.info(f"Found {len(problems)} problem(s)")
+        sys.exit(1 if problems else 0)
 
-    # Substitute variables
-    logging.info("Substituting variables ...")
-    substitute_variables(
-        results_dir,
-        values,
-        output_format,
-        additional_context={
-            "confluence_domain": args.domain,
-            "confluence_path": args.path,
-            "confluence_space": args.space,
-        },
-    )
-
-    if output_format == OutputFormat.CONFLUENCE:
-        # Publish the processed files to Confluence
-        publish(
-            results_dir,
-            confluence_domain=args.domain,
-            confluence_path=args.path,
-            confluence_space=args.space,
-            confluence_username=args.username,
-            confluence_apikey=args.apikey,
+    values_paths = [os.path.abspath(path) for path in args.values_file]
+    if len(args.values_file) == 1 and not os.path.isdir(args.values_file[0]):
+        # Read values file
+        values = read_values(args.values_file[0])
+        manifest = load_manifest(args.cache_dir, args.results_dir, force=args.force)
+
+        profiled_build(
+            args,
+            build,
+            values=values,
+            manifest=manifest,
+            force=args.force,
+            **build_args(args),
+            **confluence_args(args),
+        )
+
+        def rebuild(changed_paths):
+            nonlocal values
+            if set(values_paths) & set(map(os.path.abspath, changed_paths)):
+                values = read_values(args.values_file[0])
+            profiled_build(
+                args,
+                build,
+                values=values,
+                manifest=manifest,
+                **build_args(args),
+                **confluence_args(args),
+            )
+            logging.info("Done.")
+
+    else:
+        # Render the templates once per values file
+        if args.output_format != OutputFormat.GITBOOK.name:
+            parser.error("Several values files require the GITBOOK output format")
+        inputs = read_variants(args.values_file)
+        manifests = {}
+        profiled_build(
+            args,
+            build_variants,
+            inputs=inputs,
+            manifests=manifests,
+            force=args.force,
+            **build_args(args),
         )
 
+        def rebuild(changed_paths):
+            nonlocal inputs
+            changed_paths = list(map(os.path.abspath, changed_paths))
+            if any(
+                path == values_path or path.startswith(values_path + os.sep)
+                for path in changed_paths
+                for values_path in values_paths
+            ):
+                inputs = read_variants(args.values_file)
+            profiled_build(
+                args,
+                build_variants,
+                inputs=inputs,
+                manifests=manifests,
+                **build_args(args),
+            )
+            logging.info("Done.")
+
     logging.info("Done.")
+
+    if args.watch:
+        # Keep the values, the manifests and the Jinja environments loaded, and rebuild
+        # only the files affected by the changes (see `build`).
+        watch(
+            [
+                args.templates_dir,
+                args.overrides_dir,
+                *args.override_dir,
+                *args.partials_dir,
+                *values_paths,
+            ],
+            rebuild,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import gzip
+import io
+import logging
+import os
+import secrets
+import tarfile
+import time
+import zipfile
+
+from typing import Dict, Tuple
+
+from . import profiling
+from .documents import DocumentSet
+
+# Suffixes of the supported archives, mapped to their format
+ARCHIVE_FORMATS = {
+    ".tar": "tar",
+    ".tar.gz": "tar.gz",
+    ".tgz": "tar.gz",
+    ".zip": "zip",
+}
+
+
+def archive_format(path) -> str:
+    """
+    Returns the format of the archive at the given path (one of the values of
+    ARCHIVE_FORMATS), or None if the path is not that of an archive (eg: a folder).
+    """
+    for suffix, format in ARCHIVE_FORMATS.items():
+        if str(path).lower().endswith(suffix):
+            return format
+    return None
+
+
+def is_archive(path) -> bool:
+    return archive_format(path) is not None
+
+
+def read_archive(path) -> DocumentSet:
+    """
+    Reads all the files of the given archive into a document set, in the order of the
+    archive, without extracting them. Tar archives are read as a stream, in a single
+    pass. Raises a ValueError if a member has an absolute path or one outside of the
+    root of the archive (eg: "../x").
+    """
+    documents = {}
+    for name, (data, _mtime) in _read_members(path).items():
+        profiling.count_bytes("bytes_read", data)
+        documents[name] = data.decode()
+    return documents
+
+
+def write_archive(path, documents: DocumentSet) -> Dict[str, int]:
+    """
+    Saves the documents to an archive at the given path, in a single sequential pass
+    over a temporary file that is then renamed over the previous archive, if any.
+
+    The members whose contents did not change keep the modification time they had in
+    the previous archive, and the archive is only written if any member changed, was
+    added or was removed, so that unchanged archives keep their modification time too.
+    Returns the number of members written (i.e., new or changed), unchanged and
+    removed.
+    """
+    try:
+        previous = _read_members(path)
+    except (OSError, tarfile.TarError, zipfile.BadZipFile, EOFError):
+        previous = {}
+
+    now = int(time.time())
+    members = []
+    written = 0
+    for name, text in documents.items():
+        data = text.encode()
+        previous_data, mtime = previous.get(name, (None, now))
+        if data != previous_data:
+            mtime = now
+            written += 1
+        members.append((name, data, mtime))
+    removed = len(set(previous) - set(documents))
+    counts = {
+        "written": written,
+        "unchanged": len(documents) - written,
+        "removed": removed,
+    }
+    if not written and not removed and os.path.exists(path):
+        return counts
+
+    logging.info(f"Writing {path}")
+    directory, file_name = os.path.split(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, f".{file_name}.{secrets.token_hex(4)}.tmp")
+    try:
+        with open(temp_path, "xb") as f:
+            _write_members(f, archive_format(path), members)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    profiling.count_bytes("bytes_written", sum(len(data) for _, data, _ in members))
+    return counts
+
+
+def _read_members(path) -> Dict[str, Tuple[bytes, int]]:
+    # The contents and modification time of each file of the archive, by its path
+    # relative to the root of the archive
+    members = {}
+    if archive_format(path) == "zip":
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    mtime = int(time.mktime(info.date_time + (0, 0, -1)))
+                    members[_member_name(info.filename)] = (archive.read(info), mtime)
+    else:
+        with tarfile.open(path, "r|*") as archive:
+            for info in archive:
+                if info.isfile():
+                    data = archive.extractfile(info).read()
+                    members[_member_name(info.name)] = (data, int(info.mtime))
+    return members
+
+
+def _write_members(f, format: str, members) -> None:
+    if format == "zip":
+        with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+            for name, data, mtime in members:
+                info = zipfile.ZipInfo(_archive_name(name), time.localtime(mtime)[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                archive.writestr(info, data)
+        return
+
+    # The gzip header does not record the name of the temporary file, nor the time,
+    # so that the same members always result in the same archive
+    fileobj = f
+    if format == "tar.gz":
+        fileobj = gzip.GzipFile(filename="", mode="wb", fileobj=f, mtime=0)
+    with tarfile.open(fileobj=fileobj, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for name, data, mtime in members:
+            info = tarfile.TarInfo(_archive_name(name))
+            info.size = len(data)
+            info.mtime = mtime
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+    if fileobj is not f:
+        fileobj.close()
+
+
+def _member_name(name: str) -> str:
+    # Archives created from within the root folder (eg: `tar -czf docs.tgz .`) have
+    # their members prefixed with "./". The members are not extracted, so the names
+    # that would be written outside of the results folder are rejected here.
+    while name.startswith("./"):
+        name = name[2:]
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise ValueError(f"Archive member outside of the archive's root: {name}")
+    return path
+
+
+def _archive_name(path: str) -> str:
+    return path.replace(os.sep, "/")
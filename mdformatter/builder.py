@@ -0,0 +1,336 @@
+import logging
+import os
+
+from typing import Dict, List, Optional, Sequence, Union
+
+from . import profiling
+from .archives import is_archive
+from .check import check_documents
+from .manifest import Manifest, manifest_path
+from .pipeline import (
+    format_templates,
+    load_documents,
+    override_layers,
+    render_documents,
+    render_variants,
+)
+from .substitute import OutputFormat
+
+
+def build(
+    templates_dir,
+    overrides_dir: Union[str, Sequence[str]],
+    results_dir,
+    values: Dict,
+    output_format: OutputFormat = OutputFormat.GITBOOK,
+    jobs: int = 1,
+    cache_dir: Optional[str] = None,
+    manifest: Optional[Manifest] = None,
+    force: bool = False,
+    partials_dir: Optional[Union[str, Sequence[str]]] = None,
+    confluence_domain: Optional[str] = None,
+    confluence_path: Optional[str] = None,
+    confluence_space: Optional[str] = None,
+    confluence_username: Optional[str] = None,
+    confluence_apikey: Optional[str] = None,
+    confluence_rootpage: Optional[str] = None,
+    confluence_workers: int = 1,
+    confluence_rate_limit: Optional[float] = None,
+    confluence_max_retries: Optional[int] = None,
+) -> Dict[str, int]:
+    """
+    Merges the markdowns, substitutes their variables and, for the CONFLUENCE output
+    format, publishes them. This is what `python -m mdformatter` runs, without parsing
+    the command line or configuring the logging. The Confluence dependencies are only
+    imported for the CONFLUENCE output format. Returns the number of results written,
+    unchanged and removed (see `report_results`).
+
+    Parameters
+    ----------
+    templates_dir: str
+        Path to the Markdown templates root folder, or archive (see `is_archive`)
+    overrides_dir: Union[str, Sequence[str]]
+        Path to the Markdown overrides root folder or archive, or a list of them
+        (layers), in which case the overrides of the latter layers take precedence
+    results_dir: str
+        Path to the folder, or archive (GITBOOK only), where the resulting markdowns
+        should be stored
+    values: Dict
+        The values to be applied to the variables in the templates
+    output_format: OutputFormat, default GITBOOK
+        The desired output format
+    jobs: int, default 1
+        The maximum number of worker processes to use
+    cache_dir: str, optional
+        Path to the folder where the build cache should be stored: the manifest of the
+        results (unless one is given), the compiled templates and the state of the
+        published pages. Without it, all the files are processed and published.
+    manifest: Manifest, optional
+        The manifest of the results, if already loaded (eg: in watch mode). Files whose
+        inputs did not change since it was last saved are skipped.
+    force: bool, default False
+        Process and publish all the files, regardless of the build cache
+    partials_dir: Union[str, Sequence[str]], optional
+        Path to the folder or archive of the templates that can be included or imported
+        by the others (see `PartialsLoader`), or a list of them (layers), in which case
+        the overrides of the latter layers take precedence. The partials are not
+        rendered on their own, so it should not be inside the templates folder.
+    confluence_*:
+        The Confluence options of the CONFLUENCE output format (see `preprocess`,
+        `publish` and `confluence_session`)
+    """
+    if manifest is None and cache_dir is not None:
+        manifest = load_manifest(cache_dir, results_dir, force=force)
+
+    additional_context = {
+        "confluence_domain": confluence_domain,
+        "confluence_path": confluence_path,
+        "confluence_space": confluence_space,
+    }
+
+    bytecode_cache_dir = None
+    if cache_dir is not None:
+        bytecode_cache_dir = os.path.join(cache_dir, "bytecode")
+
+    partials_dirs = _partials_layers(partials_dir)
+
+    if output_format == OutputFormat.CONFLUENCE:
+        if is_archive(results_dir):
+            raise ValueError("Results cannot be saved to an archive to be published")
+
+        from .confluence.api import page_index, preprocess, publish, publish_state_path
+        from .confluence.session import confluence_session
+        from .gitbooktags.confluence import (
+            check_page_references,
+            page_reference_dependencies,
+        )
+
+        # Merge markdowns
+        logging.info("Merging markdowns ...")
+        with profiling.span("merge"):
+            documents = load_documents(templates_dir, overrides_dir, jobs=jobs)
+        check_page_references(documents, documents)
+
+        # The same connections to Confluence are used for preprocessing and publishing
+        with confluence_session(
+            confluence_domain=confluence_domain,
+            confluence_path=confluence_path,
+            confluence_space=confluence_space,
+            confluence_username=confluence_username,
+            confluence_apikey=confluence_apikey,
+            pool_size=confluence_workers,
+            max_retries=confluence_max_retries,
+        ) as session:
+            # Preprocess documents. This needs all the merged documents, so it is done
+            # only once the merging of all the documents is complete.
+            with profiling.span("preprocess"):
+                documents = preprocess(
+                    documents,
+                    confluence_domain=confluence_domain,
+                    confluence_path=confluence_path,
+                    confluence_space=confluence_space,
+                    confluence_username=confluence_username,
+                    confluence_apikey=confluence_apikey,
+                    confluence_rootpage=confluence_rootpage,
+                    confluence_workers=confluence_workers,
+                    confluence_rate_limit=confluence_rate_limit,
+                    session=session,
+                )
+
+            # Substitute variables and save the results. Documents that did not change
+            # since the previous run, nor did the pages they reference, are skipped.
+            logging.info("Substituting variables ...")
+            with profiling.span("render"):
+                results = render_documents(
+                    documents,
+                    results_dir,
+                    values,
+                    output_format,
+                    additional_context=additional_context,
+                    jobs=jobs,
+                    manifest=manifest,
+                    dependencies=page_reference_dependencies(
+                        documents, page_index(documents)
+                    ),
+                    bytecode_cache_dir=bytecode_cache_dir,
+                    partials_dirs=partials_dirs,
+                )
+
+            # Publish the processed files to Confluence
+            state_path = None
+            if cache_dir is not None:
+                state_path = publish_state_path(
+                    cache_dir, confluence_domain, confluence_space
+                )
+            with profiling.span("publish"):
+                publish(
+                    results_dir,
+                    confluence_domain=confluence_domain,
+                    confluence_path=confluence_path,
+                    confluence_space=confluence_space,
+                    confluence_username=confluence_username,
+                    confluence_apikey=confluence_apikey,
+                    state_path=state_path,
+                    force=force,
+                    session=session,
+                )
+    elif any(
+        map(is_archive, [templates_dir, *override_layers(overrides_dir), results_dir])
+    ):
+        # Archives are read and written in a single pass, so all the markdowns are
+        # merged before their variables are substituted
+        logging.info("Merging markdowns ...")
+        with profiling.span("merge"):
+            documents = load_documents(templates_dir, overrides_dir, jobs=jobs)
+
+        logging.info("Substituting variables ...")
+        with profiling.span("render"):
+            results = render_documents(
+                documents,
+                results_dir,
+                values,
+                output_format,
+                additional_context=additional_context,
+                jobs=jobs,
+                manifest=manifest,
+                bytecode_cache_dir=bytecode_cache_dir,
+                partials_dirs=partials_dirs,
+            )
+    else:
+        # Merge markdowns and substitute variables, one file at a time. Files whose
+        # inputs did not change since the previous run are skipped.
+        logging.info("Merging markdowns and substituting variables ...")
+        with profiling.span("format"):
+            results = format_templates(
+                templates_dir,
+                overrides_dir,
+                results_dir,
+                values,
+                output_format,
+                additional_context=additional_context,
+                jobs=jobs,
+                manifest=manifest,
+                bytecode_cache_dir=bytecode_cache_dir,
+                partials_dirs=partials_dirs,
+            )
+
+    return results
+
+
+def build_variants(
+    templates_dir,
+    overrides_dir: Union[str, Sequence[str]],
+    results_dir,
+    inputs: Dict[str, Dict],
+    output_format: OutputFormat = OutputFormat.GITBOOK,
+    jobs: int = 1,
+    cache_dir: Optional[str] = None,
+    manifests: Optional[Dict[str, Manifest]] = None,
+    force: bool = False,
+    partials_dir: Optional[Union[str, Sequence[str]]] = None,
+) -> Dict[str, int]:
+    """
+    Merges the markdowns once and substitutes their variables against the values of
+    each variant, to a subfolder of the results folder named after the variant (see
+    `render_variants`). Only the GITBOOK output format is supported, as the variants
+    would be published to the same Confluence pages. Returns the number of results
+    written, unchanged and removed, over all the variants.
+
+    Parameters
+    ----------
+    inputs: Dict[str, Dict]
+        Map of the name of each variant to the values to be applied to the variables
+    manifests: Dict[str, Manifest], optional
+        The manifests of the variants, by name, if already loaded (eg: in watch mode).
+        The manifests of the variants missing from it are loaded from the cache folder
+        and added to it.
+
+    See `build` for the other parameters.
+    """
+    if output_format != OutputFormat.GITBOOK:
+        raise ValueError("Several values files require the GITBOOK output format")
+
+    if cache_dir is not None:
+        if manifests is None:
+            manifests = {}
+        for name in inputs:
+            if name not in manifests:
+                manifests[name] = load_manifest(
+                    cache_dir, os.path.join(results_dir, name), force=force
+                )
+
+    logging.info("Merging markdowns ...")
+    with profiling.span("merge"):
+        documents = load_documents(templates_dir, overrides_dir, jobs=jobs)
+
+    logging.info(f"Substituting variables for {len(inputs)} values files ...")
+    with profiling.span("render"):
+        results = render_variants(
+            documents,
+            results_dir,
+            inputs,
+            output_format,
+            additional_context={
+                "confluence_domain": None,
+                "confluence_path": None,
+                "confluence_space": None,
+            },
+            jobs=jobs,
+            manifests=(
+                {name: manifests[name] for name in inputs}
+                if manifests is not None
+                else None
+            ),
+            bytecode_cache_dir=(
+                os.path.join(cache_dir, "bytecode") if cache_dir is not None else None
+            ),
+            partials_dirs=_partials_layers(partials_dir),
+        )
+
+    return results
+
+
+def check(
+    templates_dir,
+    overrides_dir: Union[str, Sequence[str]],
+    inputs: Dict[str, Dict],
+    output_format: OutputFormat = OutputFormat.GITBOOK,
+    jobs: int = 1,
+    partials_dir: Optional[Union[str, Sequence[str]]] = None,
+) -> List[str]:
+    """
+    Merges the markdowns and checks them without rendering them nor writing anything
+    (see `check_documents`), against the values of each of the given values files, by
+    name. Returns the problems found. See `build` for the partials folder.
+    """
+    logging.info("Merging markdowns ...")
+    with profiling.span("merge"):
+        documents = load_documents(templates_dir, overrides_dir, jobs=jobs)
+
+    logging.info("Checking markdowns ...")
+    with profiling.span("check"):
+        return check_documents(
+            documents,
+            inputs,
+            output_format,
+            jobs=jobs,
+            partials_dirs=_partials_layers(partials_dir),
+        )
+
+
+def load_manifest(cache_dir, results_dir, force: bool = False) -> Manifest:
+    """
+    Loads the manifest of the given results folder from the cache folder, or returns
+    an empty one if `force` is set, so that all the files are processed.
+    """
+    path = manifest_path(cache_dir, results_dir)
+    return Manifest(path) if force else Manifest.load(path)
+
+
+def _partials_layers(
+    partials_dir: Optional[Union[str, Sequence[str]]],
+) -> Optional[List[str]]:
+    # The partials folder and its override layers, if any (see `override_layers`)
+    if partials_dir is None:
+        return None
+    return override_layers(partials_dir) or None
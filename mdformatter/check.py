@@ -0,0 +1,249 @@
+import functools
+import re
+
+from typing import Container, Dict, List, Optional, Sequence, Set, Tuple
+
+from jinja2 import TemplateSyntaxError, meta, nodes
+
+from . import profiling
+from .documents import DocumentSet
+from .gitbooktags.pagerefs import PAGE_REF_PATTERN, resolve_page_reference
+from .parallel import map_files
+from .partials import PartialsLoader
+from .substitute import OutputFormat, get_environment, prepare_text
+
+# The opening of a tag, and its name
+TAG_PATTERN = re.compile(r"{%-?\s*([\w-]+)")
+
+# Gitbook tags, which are kept as they are by the GITBOOK output format
+GITBOOK_TAGS = {
+    "code",
+    "endcode",
+    "content-ref",
+    "endcontent-ref",
+    "embed",
+    "file",
+    "hint",
+    "endhint",
+    "page-ref",
+    "swagger",
+    "endswagger",
+    "tab",
+    "endtab",
+    "tabs",
+    "endtabs",
+}
+
+# Jinja statements that load or define partials, which are also supported by the
+# GITBOOK output format (see `prepare_text`)
+PARTIAL_TAGS = {"include", "import", "from", "macro", "endmacro"}
+
+# Jinja statements
+JINJA_TAGS = {
+    "autoescape",
+    "endautoescape",
+    "block",
+    "endblock",
+    "call",
+    "endcall",
+    "elif",
+    "else",
+    "extends",
+    "filter",
+    "endfilter",
+    "for",
+    "endfor",
+    "from",
+    "if",
+    "endif",
+    "import",
+    "include",
+    "macro",
+    "endmacro",
+    "raw",
+    "endraw",
+    "set",
+    "endset",
+    "with",
+    "endwith",
+}
+
+# Tags supported by the CONFLUENCE output format, without their "-" (see
+# `prepare_text`): the Gitbook tags converted by the extensions, and the Jinja
+# statements
+CONFLUENCE_TAGS = {
+    "code",
+    "endcode",
+    "embed",
+    "hint",
+    "endhint",
+    "pageref",
+} | JINJA_TAGS
+
+# Variables that are provided to every template when rendering (see `render_template`)
+CONTEXT_VARIABLES = {
+    "file_path",
+    "page_index",
+    "additional_context",
+    "_referenced_variables",
+}
+
+
+def check_documents(
+    documents: DocumentSet,
+    inputs: Dict[str, Dict],
+    output_format: OutputFormat,
+    jobs: int = 1,
+    partials_dirs: Optional[Sequence[str]] = None,
+) -> List[str]:
+    """
+    Checks the merged documents without rendering them and returns the problems found,
+    as "<path>:<line>: <problem>", ordered by path and line. Each document is parsed
+    once, independently of the others, using up to `jobs` worker processes.
+
+    The problems are:
+    - the variables that are used without a default value (i.e., the `default` filter)
+      and that are missing from the values
+    - the tags that are not supported by the output format
+    - the page references to pages that are not among the documents
+    - the included or imported templates that are not found in the partials folders
+      (see `PartialsLoader`), if any. With the GITBOOK output format, those are kept as
+      Gitbook tags instead (see `prepare_text`).
+    - any other syntax error, which prevents the variables of the document from being
+      checked
+
+    Parameters
+    ----------
+    documents: DocumentSet
+        The merged documents
+    inputs: Dict[str, Dict]
+        Map of the name of each values file to its values. The variables are checked
+        against each of them.
+    output_format: OutputFormat
+        The desired output format
+    jobs: int, default 1
+        The maximum number of worker processes to use
+    partials_dirs: Sequence[str], optional
+        The partials folder followed by its override folders, from which the included
+        templates are loaded
+    """
+    problems = map_files(
+        functools.partial(
+            _check_document,
+            variables={name: set(values) for name, values in inputs.items()},
+            output_format=output_format,
+            page_paths=set(documents),
+            partials_dirs=partials_dirs,
+        ),
+        list(documents.items()),
+        jobs=jobs,
+    )
+    return [problem for document_problems in problems for problem in document_problems]
+
+
+def _check_document(
+    document: Tuple[str, str],
+    variables: Dict[str, Set[str]],
+    output_format: OutputFormat,
+    page_paths: Container[str],
+    partials_dirs: Optional[Sequence[str]],
+) -> List[str]:
+    path, text = document
+    problems = []  # (line, problem)
+    with profiling.span(path, profiling.FILE, stage="check"):
+        # The unknown tags are removed (keeping the lines) before the text is parsed,
+        # so that the rest of the text can still be checked
+        parts, end = [], 0
+        for match in TAG_PATTERN.finditer(text):
+            tag = match.group(1)
+            if output_format == OutputFormat.GITBOOK:
+                known = tag in GITBOOK_TAGS or tag in PARTIAL_TAGS
+            else:
+                known = tag.replace("-", "") in CONFLUENCE_TAGS
+            if not known and match.start() >= end:
+                problems.append((_line(text, match), f"Unknown tag '{tag}'"))
+                tag_end = text.find("%}", match.end())
+                tag_end = len(text) if tag_end < 0 else tag_end + 2
+                parts.append(text[end : match.start()])
+                parts.append("\n" * text.count("\n", match.start(), tag_end))
+                end = tag_end
+        parts.append(text[end:])
+
+        for match in PAGE_REF_PATTERN.finditer(text):
+            page_path = resolve_page_reference(path, match.group(2))
+            if page_path not in page_paths:
+                problems.append(
+                    (_line(text, match), f"Referenced page not found: {page_path}")
+                )
+
+        env = get_environment(output_format, partials_dirs=partials_dirs)
+        partials = env.loader if isinstance(env.loader, PartialsLoader) else None
+        try:
+            ast = env.parse(
+                prepare_text("".join(parts), output_format, partials=partials)
+            )
+        except TemplateSyntaxError as e:
+            problems.append((e.lineno, e.message))
+            ast = None
+
+        if ast is not None and partials is not None:
+            for line, template in _included_templates(ast):
+                if not partials.exists(template):
+                    problems.append((line, f"Included template not found: {template}"))
+
+        if ast is not None:
+            for name, line in _required_variables(ast).items():
+                if name in env.globals or name in CONTEXT_VARIABLES:
+                    continue
+                for values_name, names in variables.items():
+                    if name not in names:
+                        problem = f"'{name}' is undefined"
+                        if len(variables) > 1:
+                            problem += f" in {values_name}"
+                        problems.append((line, problem))
+
+    problems.sort(key=lambda problem: problem[0])
+    return [f"{path}:{line}: {problem}" for line, problem in problems]
+
+
+def _required_variables(ast: nodes.Template) -> Dict[str, int]:
+    # The variables of the template that must be given a value, with the line of their
+    # first use: those that are used at least once without a default value, and that
+    # are never tested for being defined.
+    undeclared = meta.find_undeclared_variables(ast)
+    with_default, tested = set(), set()
+    for node in ast.find_all(nodes.Filter):
+        if node.name in ("default", "d") and isinstance(node.node, nodes.Name):
+            with_default.add(id(node.node))
+    for node in ast.find_all(nodes.Test):
+        if node.name in ("defined", "undefined") and isinstance(node.node, nodes.Name):
+            tested.add(node.node.name)
+
+    required = {}
+    for node in ast.find_all(nodes.Name):
+        if (
+            node.ctx == "load"
+            and node.name in undeclared
+            and node.name not in tested
+            and id(node) not in with_default
+        ):
+            required.setdefault(node.name, node.lineno)
+    return required
+
+
+def _included_templates(ast: nodes.Template) -> List[Tuple[int, str]]:
+    # The line and name of the templates that are included (unless they can be
+    # missing) or imported by the template, when they are given as a string
+    templates = []
+    for node in ast.find_all((nodes.Include, nodes.Import, nodes.FromImport)):
+        if getattr(node, "ignore_missing", False):
+            continue
+        if isinstance(node.template, nodes.Const) and isinstance(
+            node.template.value, str
+        ):
+            templates.append((node.lineno, node.template.value))
+    return templates
+
+
+def _line(text: str, match: re.Match) -> int:
+    return text.count("\n", 0, match.start()) + 1
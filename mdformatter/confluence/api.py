@@ -1,81 +1,150 @@
+import hashlib
 import json
 import logging
+import mimetypes
 import os
 import sys
 import requests
 
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
 from .doctree import build_tree, Node
+from .ratelimit import RateLimiter
+from .session import session_or_new
+from .. import profiling
+from ..documents import DocumentSet
+from ..manifest import digest
+
+from md2conf.api import build_url, ConfluenceError, ConfluenceSession, removeprefix
+from md2conf.converter import (
+    ConfluenceDocument,
+    ConfluenceDocumentOptions,
+    ConfluencePageMetadata,
+    DocumentError,
+    extract_page_id,
+    extract_value,
+)
 
-from md2conf.api import build_url, ConfluenceAPI, ConfluenceError, ConfluenceSession
-from md2conf.application import Application
-from md2conf.converter import ConfluenceDocumentOptions, DocumentError, extract_value
+# Maximum number of pages to request per batch, when listing the pages of a space
+PAGE_LISTING_LIMIT = 200
 
 
 def preprocess(
-    markdowns_dir,
+    documents: DocumentSet,
     confluence_domain,
     confluence_path,
     confluence_space,
     confluence_username,
     confluence_apikey,
     confluence_rootpage,
-):
+    confluence_workers: int = 1,
+    confluence_rate_limit: Optional[float] = None,
+    session: Optional[ConfluenceSession] = None,
+) -> DocumentSet:
     """
     Preprocess all the pages and create missing ones. The page id will be added to the
     documents for publishing later.
+
+    Pages are created one level of the page tree at a time, as the pages of a level
+    only depend on their parents. All the missing pages of a level are created
+    concurrently, using up to `confluence_workers` threads. The pages created under
+    the same parent are then moved in the order of their rank, as Confluence orders
+    them by creation. At most `confluence_rate_limit` requests are sent per second, if
+    set.
+
+    The requests are sent with the given session (see `confluence_session`), so that
+    it can be shared with `publish`, or with a new one.
+
+    Returns
+    -------
+    DocumentSet
+        The preprocessed documents
     """
-    with ConfluenceAPI(
-        domain=confluence_domain,
-        base_path=confluence_path,
-        space_key=confluence_space,
-        user_name=confluence_username,
-        api_key=confluence_apikey,
+    with session_or_new(
+        session,
+        confluence_domain,
+        confluence_path,
+        confluence_space,
+        confluence_username,
+        confluence_apikey,
+        pool_size=confluence_workers,
     ) as session:
-        logging.info(f"Preprocessing files at {markdowns_dir}")
+        logging.info(f"Preprocessing {len(documents)} documents")
 
         # Build a tree of pages: id is the page title and parent_id is the parent page title.
         # Note: For a given Confluence space, the page titles are unique which allows us to
         # treat the page title like an id.
+        page_titles = {}  # map of document path to page-title
         nodes = [Node(id=confluence_rootpage, parent_id=None, rank=0)]
-        for root, _dirs, files in os.walk(markdowns_dir):
-            for idx, file in enumerate(sorted(files)):
-                file_path = os.path.join(root, file)
-                with open(file_path, "r") as f:
-                    file_contents = f.read()
-                    page_title = parse_page_title(file_contents)
-                    parent_page_title = parse_parent_page_title(file_contents)
-                    nodes.append(
-                        Node(
-                            id=page_title,
-                            parent_id=parent_page_title or confluence_rootpage,
-                            rank=idx,
-                        )
+        for paths in _group_by_directory(documents):
+            for idx, path in enumerate(sorted(paths, key=os.path.basename)):
+                file_contents = documents[path]
+                page_title = parse_page_title(file_contents)
+                parent_page_title = parse_parent_page_title(file_contents)
+                page_titles[path] = page_title
+                nodes.append(
+                    Node(
+                        id=page_title,
+                        parent_id=parent_page_title or confluence_rootpage,
+                        rank=idx,
                     )
-        parsed_nodes = build_tree(nodes)
+                )
+        with profiling.span("build_tree"):
+            parsed_nodes = build_tree(nodes)
 
         # Create the missing pages
+        rate_limiter = RateLimiter(confluence_rate_limit)
+        with profiling.span("list_pages"):
+            page_ids = _get_page_ids(session)
         page_id_map = {}  # map of page-title to Confluence page-id
-        for node in parsed_nodes:
-            parent_id = (
-                page_id_map[node.parent_id] if node.parent_id in page_id_map else None
-            )
-            page_id = _get_or_create_page(session, node.id, parent_id)
-            page_id_map[node.id] = page_id
+        with profiling.span("create_pages"), ThreadPoolExecutor(
+            max_workers=confluence_workers
+        ) as executor:
+            moves = []
+            for level in _group_by_level(parsed_nodes):
+                # The pages to be created under each parent, in the order of their rank
+                created = {
+                    parent_id: [node.id for node in siblings if node.id not in page_ids]
+                    for parent_id, siblings in level.items()
+                }
+                futures = {
+                    node.id: executor.submit(
+                        _get_or_create_page,
+                        session,
+                        node.id,
+                        page_id_map.get(parent_id),
+                        page_ids,
+                        rate_limiter,
+                    )
+                    for parent_id, siblings in level.items()
+                    for node in siblings
+                }
+                for page_title, future in futures.items():
+                    page_id_map[page_title] = future.result()
 
-        # Add the page id to the docs as a comment as well as the Table of Contents
-        for root, _dirs, files in os.walk(markdowns_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                updated_contents = ""
-                with open(file_path, "r") as f:
-                    file_contents = f.read()
-                    page_title = parse_page_title(file_contents)
-                    updated_contents = _add_page_id(
-                        file_contents, page_id_map[page_title]
+                # The pages of the next levels do not depend on the order of these
+                moves.extend(
+                    executor.submit(
+                        _order_pages,
+                        session,
+                        [page_id_map[page_title] for page_title in page_titles],
+                        rate_limiter,
                     )
-                    updated_contents = _add_toc(updated_contents)
-                with open(file_path, "w") as f:
-                    f.write(updated_contents)
+                    for page_titles in created.values()
+                    if len(page_titles) > 1
+                )
+            for future in moves:
+                future.result()
+
+        # Add the page id to the docs as a comment as well as the Table of Contents
+        preprocessed_documents = {}
+        for path, file_contents in documents.items():
+            updated_contents = _add_page_id(
+                file_contents, page_id_map[page_titles[path]]
+            )
+            preprocessed_documents[path] = _add_toc(updated_contents)
+        return preprocessed_documents
 
 
 def publish(
@@ -85,20 +154,37 @@ def publish(
     confluence_space,
     confluence_username,
     confluence_apikey,
+    state_path: Optional[str] = None,
+    force: bool = False,
+    session: Optional[ConfluenceSession] = None,
 ):
     """
-    Publish the pages to Confluence
+    Publish the pages to Confluence.
+
+    If a state path is provided, the digest of each published page (its Confluence
+    storage format body) and of each of its attachments are saved there. Pages and
+    attachments whose digest did not change since they were last published are
+    skipped, unless `force` is set. Attachments are also skipped if the same content
+    was already uploaded to the page (eg: by another run), as recorded in the comment
+    of the attachment in Confluence.
+
+    The requests are sent with the given session (see `confluence_session`), or with a
+    new one.
     """
-    with ConfluenceAPI(
-        domain=confluence_domain,
-        base_path=confluence_path,
-        space_key=confluence_space,
-        user_name=confluence_username,
-        api_key=confluence_apikey,
+    with session_or_new(
+        session,
+        confluence_domain,
+        confluence_path,
+        confluence_space,
+        confluence_username,
+        confluence_apikey,
     ) as session:
         logging.info(f"Publishing files at {markdowns_dir}")
+        state = {"pages": {}, "attachments": {}}  # see _synchronize_directory
+        if state_path is not None and not force:
+            state = _load_publish_state(state_path)
         try:
-            Application(session, ConfluenceDocumentOptions()).synchronize(markdowns_dir)
+            _synchronize_directory(session, markdowns_dir, state)
         except requests.exceptions.HTTPError as err:
             logging.error(err)
             # Print details for a response with JSON body
@@ -108,6 +194,20 @@ def publish(
                 except requests.exceptions.JSONDecodeError:
                     pass
             sys.exit(1)
+        finally:
+            # Save the state even if publishing fails midway, so that the pages
+            # published so far are skipped the next time.
+            if state_path is not None:
+                _save_publish_state(state_path, state)
+
+
+def publish_state_path(cache_dir, confluence_domain, confluence_space) -> str:
+    """
+    Returns the path of the file where the state of the pages published to the given
+    Confluence space is saved.
+    """
+    key = digest(confluence_domain, confluence_space)[:16]
+    return os.path.join(cache_dir, "publish", f"{key}.json")
 
 
 def parse_page_id(text: str) -> str:
@@ -150,6 +250,196 @@ def parse_parent_page_title(text: str) -> str:
     return parent_page_title
 
 
+def page_index(documents: DocumentSet) -> Dict[str, Tuple[str, str]]:
+    """
+    Returns a map of each preprocessed document's path to its Confluence page id and
+    page title.
+    """
+    return {
+        path: (parse_page_id(text), parse_page_title(text))
+        for path, text in documents.items()
+    }
+
+
+def _group_by_directory(documents: DocumentSet) -> List[List[str]]:
+    # Group the paths of the documents by their directory, in the order the directories
+    # are first encountered.
+    directories = {}
+    for path in documents:
+        directories.setdefault(os.path.dirname(path), []).append(path)
+    return list(directories.values())
+
+
+def _synchronize_directory(
+    session: ConfluenceSession, markdowns_dir, state: Dict[str, Dict]
+) -> None:
+    """
+    Converts the markdown pages in the given directory to the Confluence storage format
+    and updates the pages and attachments whose digest is not in the state.
+    Equivalent to md2conf's Application.synchronize, without looking up each page.
+
+    The state maps page ids to the digest of their contents ("pages"), and page ids to
+    the digest of each of their attachments, by name ("attachments").
+    """
+    # Build an index of all page metadata, used to resolve the links between pages
+    page_metadata: Dict[str, ConfluencePageMetadata] = {}
+    for root, _dirs, files in os.walk(markdowns_dir):
+        for file_name in files:
+            if os.path.splitext(file_name)[1].lower() != ".md":
+                continue
+            absolute_path = os.path.join(os.path.abspath(root), file_name)
+            with open(absolute_path, "r") as f:
+                text = f.read()
+            profiling.count_bytes("bytes_read", text)
+            id, _ = extract_page_id(text)
+            page_metadata[absolute_path] = ConfluencePageMetadata(
+                domain=session.domain,
+                base_path=session.base_path,
+                page_id=id.page_id,
+                space_key=id.space_key or session.space_key,
+                title=parse_page_title(text),
+            )
+
+    options = ConfluenceDocumentOptions()
+    file_digests = {}  # map of attachment file path to its digest, shared by all pages
+    published, uploaded, attachments = 0, 0, 0
+    for page_path in page_metadata:
+        relative_path = os.path.relpath(page_path, os.path.abspath(markdowns_dir))
+        with profiling.span(relative_path, profiling.FILE, stage="convert"):
+            document = ConfluenceDocument(page_path, options, page_metadata)
+            base_path = os.path.dirname(page_path)
+            content = document.xhtml()
+            page_digest = digest(content)
+
+            # An image referenced several times by a page is attached to it only once
+            attachment_digests = {}
+            for image in document.images:
+                image_path = os.path.normpath(os.path.join(base_path, image))
+                if image_path not in file_digests:
+                    file_digests[image_path] = _file_digest(image_path)
+                attachment_digests[image] = file_digests[image_path]
+
+        page_id = document.id.page_id
+        page_attachments = state["attachments"].setdefault(page_id, {})
+        changed_attachments = [
+            image
+            for image, attachment_digest in attachment_digests.items()
+            if page_attachments.get(image) != attachment_digest
+        ]
+        attachments += len(attachment_digests)
+        if state["pages"].get(page_id) == page_digest and not changed_attachments:
+            logging.debug(f"Skipping unchanged page: {page_path}")
+            continue
+
+        logging.info(f"Synchronizing page: {page_path}")
+        with profiling.span(
+            relative_path, profiling.FILE, stage="upload"
+        ), session.switch_space(document.id.space_key or session.space_key):
+            for image in changed_attachments:
+                if _upload_attachment(
+                    session,
+                    page_id,
+                    os.path.join(base_path, image),
+                    image,
+                    attachment_digests[image],
+                ):
+                    uploaded += 1
+                page_attachments[image] = attachment_digests[image]
+            if state["pages"].get(page_id) != page_digest:
+                session.update_page(page_id, content)
+                state["pages"][page_id] = page_digest
+                published += 1
+
+    logging.info(
+        f"Published {published} of {len(page_metadata)} pages and uploaded {uploaded} "
+        f"of {attachments} attachments; the others did not change"
+    )
+
+
+def _file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        data = f.read()
+    profiling.count_bytes("bytes_read", data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _upload_attachment(
+    session: ConfluenceSession,
+    page_id: str,
+    attachment_path: str,
+    attachment_name: str,
+    attachment_digest: str,
+) -> bool:
+    """
+    Uploads the file as an attachment of the page, unless the page already has an
+    attachment with the same name and digest. The digest is saved as the comment of the
+    attachment. Same as md2conf's ConfluenceSession.upload_attachment, which compares
+    attachments by their size only.
+
+    Returns
+    -------
+    True if the attachment was uploaded.
+    """
+    comment = f"sha256:{attachment_digest}"
+    try:
+        attachment = session.get_attachment_by_name(page_id, attachment_name)
+    except ConfluenceError:
+        attachment = None
+
+    if attachment is None:
+        path = f"/content/{page_id}/child/attachment"
+    elif attachment.comment == comment:
+        logging.debug(f"Skipping unchanged attachment: {attachment_name}")
+        return False
+    else:
+        path = f"/content/{page_id}/child/attachment/{removeprefix(attachment.id, 'att')}/data"
+
+    logging.info(f"Uploading attachment: {attachment_name}")
+    url = build_url(f"https://{session.domain}{session.base_path}rest/api{path}")
+    with open(attachment_path, "rb") as f:
+        response = session.session.post(
+            url,
+            files={
+                "comment": comment,
+                "file": (
+                    attachment_name,
+                    f,
+                    mimetypes.guess_type(attachment_path, strict=True)[0],
+                    {"Expires": "0"},
+                ),
+            },
+            headers={"X-Atlassian-Token": "no-check"},
+        )
+    response.raise_for_status()
+    data = response.json()
+    result = data["results"][0] if "results" in data else data
+    profiling.count_bytes("bytes_uploaded", response.request.body)
+
+    # The name of the uploaded file is truncated to its base name; restore the path
+    session._update_attachment(
+        page_id, result["id"], result["version"]["number"] + 1, attachment_name
+    )
+    return True
+
+
+def _load_publish_state(state_path: str) -> Dict[str, Dict]:
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        # State saved by an earlier version, without the attachments
+        if "pages" in state and "attachments" in state:
+            return state
+    except (OSError, ValueError):
+        pass
+    return {"pages": {}, "attachments": {}}
+
+
+def _save_publish_state(state_path: str, state: Dict[str, Dict]) -> None:
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+
+
 def _add_page_id(text: str, page_id: str) -> str:
     return f"<!-- confluence-page-id: {page_id} -->\n" + text
 
@@ -158,8 +448,73 @@ def _add_toc(text: str) -> str:
     return "[TOC]\n" + text
 
 
+def _get_page_ids(session: ConfluenceSession) -> Dict[str, str]:
+    """
+    Returns a map of page title to page id of all the pages in the space of the given
+    session. The pages are listed in bulk, a batch of pages at a time.
+    """
+    page_ids = {}
+    start = 0
+    while True:
+        url = build_url(
+            f"https://{session.domain}{session.base_path}rest/api/content",
+            {
+                "spaceKey": session.space_key,
+                "type": "page",
+                "start": str(start),
+                "limit": str(PAGE_LISTING_LIMIT),
+            },
+        )
+        response = session.session.get(url)
+        response.raise_for_status()
+        data = response.json()
+        for result in data["results"]:
+            page_ids[result["title"]] = result["id"]
+
+        # The server may return fewer results than requested; continue for as long
+        # as it indicates that there are more.
+        if not data["results"] or "next" not in data.get("_links", {}):
+            break
+        start += len(data["results"])
+
+    logging.info(f"Found {len(page_ids)} existing pages in space {session.space_key}")
+    return page_ids
+
+
+def _group_by_level(nodes: List[Node]) -> List[Dict[str, List[Node]]]:
+    # Group the nodes, sorted in width-first order, by their depth in the tree and then
+    # by their parent.
+    depths, levels = {}, []
+    for node in nodes:
+        depth = depths.get(node.parent_id, -1) + 1
+        depths[node.id] = depth
+        if depth == len(levels):
+            levels.append({})
+        levels[depth].setdefault(node.parent_id, []).append(node)
+    return levels
+
+
+def _order_pages(
+    session: ConfluenceSession, page_ids: List[str], rate_limiter: RateLimiter
+) -> None:
+    # Moves each of the given sibling pages after the previous one, in order, so that
+    # they follow each other in Confluence in that order.
+    for previous_page_id, page_id in zip(page_ids, page_ids[1:]):
+        url = build_url(
+            f"https://{session.domain}{session.base_path}rest/api/content/{page_id}"
+            f"/move/after/{previous_page_id}"
+        )
+        rate_limiter.wait()
+        response = session.session.put(url)
+        response.raise_for_status()
+
+
 def _get_or_create_page(
-    session: ConfluenceSession, page_title: str, parent_page_id: str
+    session: ConfluenceSession,
+    page_title: str,
+    parent_page_id: str,
+    page_ids: Dict[str, str],
+    rate_limiter: Optional[RateLimiter] = None,
 ) -> str:
     """
     Finds a page with the given title and returns its id.
@@ -173,30 +528,38 @@ def _get_or_create_page(
         The title of the page
     parent_page_id: str
         The id of the parent page
+    page_ids: Dict[str, str]
+        Map of page title to page id of the existing pages in the space. Created pages
+        are added to it.
+    rate_limiter: RateLimiter, optional
+        Limits the rate at which pages are created
 
     Returns
     -------
     Page id of the given page under the given parent page.
     """
-    try:
-        return session.get_page_id_by_title(page_title)
-    except ConfluenceError:
-        # Page doesn't exist, create it. Ref:
-        # https://developer.atlassian.com/server/confluence/confluence-rest-api-examples/#create-a-new-page-as-a-child-of-another-page
-        data = {
-            "type": "page",
-            "title": page_title,
-            "space": {"key": session.space_key},
-            "ancestors": [{"id": parent_page_id}],
-            "body": {"storage": {"value": "", "representation": "storage"}},
-        }
-        url = build_url(f"https://{session.domain}{session.base_path}rest/api/content")
-        logging.info(f"Creating page with title: {page_title}")
-        response = session.session.post(
-            url,
-            data=json.dumps(data),
-            headers={"Content-Type": "application/json"},
-        )
-        response.raise_for_status()
-        # Get the page again, it should succeed.
-        return session.get_page_id_by_title(page_title)
+    if page_title in page_ids:
+        return page_ids[page_title]
+
+    # Page doesn't exist, create it. Ref:
+    # https://developer.atlassian.com/server/confluence/confluence-rest-api-examples/#create-a-new-page-as-a-child-of-another-page
+    data = {
+        "type": "page",
+        "title": page_title,
+        "space": {"key": session.space_key},
+        "ancestors": [{"id": parent_page_id}],
+        "body": {"storage": {"value": "", "representation": "storage"}},
+    }
+    url = build_url(f"https://{session.domain}{session.base_path}rest/api/content")
+    logging.info(f"Creating page with title: {page_title}")
+    if rate_limiter is not None:
+        rate_limiter.wait()
+    response = session.session.post(
+        url,
+        data=json.dumps(data),
+        headers={"Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+    # The response describes the created page
+    page_ids[page_title] = response.json()["id"]
+    return page_ids[page_title]
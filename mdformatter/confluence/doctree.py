@@ -1,8 +1,15 @@
 import logging
 
-from treelib import Tree
+from collections import deque
+from typing import Dict, List, Set
 
-from typing import Dict, List
+# Sorting orders, with the same values as those of treelib
+DEPTH = 1
+WIDTH = 2
+
+
+class TreeError(ValueError):
+    pass
 
 
 class Node:
@@ -21,44 +28,86 @@ class Node:
         return str(self.to_dict())
 
 
-def build_tree(nodes: List[Node], sorting: int = Tree.WIDTH) -> List[Node]:
+def build_tree(nodes: List[Node], sorting: int = WIDTH) -> List[Node]:
     """
-    Builds a tree from the given list and returns it as a sorted list.
+    Builds a tree from the given list and returns it as a sorted list. Siblings are
+    ordered by their rank and then, by their order in the given list.
 
     Parameters
     ----------
     nodes: List[Node]
-        A list of nodes that should be parsed into a tree.
+        A list of nodes that should be parsed into a tree. Exactly one of the nodes
+        must be the root (i.e., have no parent). If multiple nodes have the same id,
+        the last one is used.
     sorting: int
-        The sorting order to be used when converting the tree back to a list.
+        The sorting order to be used when converting the tree back to a list. One of
+        {WIDTH, DEPTH}.
 
     Returns
     -------
     The parsed tree structure as a list, sorted in the specified mode.
+
+    Raises
+    ------
+    TreeError
+        If there is not exactly one root, or if some of the nodes cannot be reached
+        from the root because their parent does not exist or they form a cycle.
     """
-    node_map, node_map_clone = {}, {}
+    if sorting not in (WIDTH, DEPTH):
+        raise ValueError(f"Sorting mode '{sorting}' is not supported")
+
+    node_map = {}
     for node in nodes:
         node_map[node.id] = node
-        node_map_clone[node.id] = node
-
-    added = set()
-    tree = Tree()
-    while node_map:
-        for node_id, node in node_map.items():
-            if node.parent_id in added:
-                tree.create_node(node, node_id, parent=node.parent_id)
-                added.add(node_id)
-                node_map.pop(node_id)
-                break
-            elif node.parent_id is None:
-                tree.create_node(node, node_id)
-                added.add(node_id)
-                node_map.pop(node_id)
-                break
-    logging.debug(f"Parsed tree: {tree.to_dict()}")
-
-    # Save the results as a list and return
+
+    # Index the children of each node
+    roots, children = [], {}  # children: parent id -> list of child nodes
+    for node in node_map.values():
+        if node.parent_id is None:
+            roots.append(node)
+        else:
+            children.setdefault(node.parent_id, []).append(node)
+    if len(roots) != 1:
+        raise TreeError(
+            f"Expected exactly one root node, found: {[node.id for node in roots]}"
+        )
+
+    # Traverse the tree from the root
     parsed_nodes = []
-    for node_id in tree.expand_tree(mode=Tree.WIDTH):
-        parsed_nodes.append(node_map_clone[node_id])
+    queue = deque(roots)
+    while queue:
+        node = queue.popleft()
+        parsed_nodes.append(node)
+        expansion = sorted(children.get(node.id, []))
+        if sorting == WIDTH:
+            queue.extend(expansion)
+        else:
+            queue.extendleft(reversed(expansion))
+    logging.debug(f"Parsed tree: {parsed_nodes}")
+
+    if len(parsed_nodes) != len(node_map):
+        _raise_unreachable(node_map, {node.id for node in parsed_nodes})
     return parsed_nodes
+
+
+def _raise_unreachable(node_map: Dict, reached: Set) -> None:
+    orphaned, cyclic = [], []
+    for node_id in node_map:
+        if node_id in reached:
+            continue
+        # Follow the parents until one that does not exist or a repeated one is found
+        seen, parent_id = {node_id}, node_map[node_id].parent_id
+        while parent_id in node_map and parent_id not in seen:
+            seen.add(parent_id)
+            parent_id = node_map[parent_id].parent_id
+        if parent_id in node_map:
+            cyclic.append(node_id)
+        else:
+            orphaned.append(f"{node_id} (missing: {parent_id})")
+
+    message = "Some pages cannot be reached from the root page."
+    if orphaned:
+        message += f" Pages under a missing parent page: {orphaned}."
+    if cyclic:
+        message += f" Pages in (or under) a cycle: {cyclic}."
+    raise TreeError(message)
@@ -0,0 +1,29 @@
+import threading
+import time
+
+from typing import Optional
+
+
+class RateLimiter:
+    """
+    Limits the rate at which requests are sent, across all the threads sharing the
+    limiter. Requests are spaced evenly, at most `rate` per second.
+    """
+
+    def __init__(self, rate: Optional[float] = None) -> None:
+        self.interval = 1.0 / rate if rate else 0.0  # No limit if rate is not set
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        """
+        Blocks until the next request is allowed to be sent.
+        """
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            send_time = max(now, self.next_time)
+            self.next_time = send_time + self.interval
+        if send_time > now:
+            time.sleep(send_time - now)
@@ -0,0 +1,110 @@
+import contextlib
+import logging
+
+from typing import Iterator, Optional
+
+from md2conf.api import ConfluenceAPI, ConfluenceSession
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .. import profiling
+
+# Maximum number of times a request is retried, when throttled or on a server error
+MAX_RETRIES = 5
+# Retries are delayed exponentially: 0.5s, 1s, 2s, ... up to BACKOFF_MAX seconds, unless
+# the server asks for a specific delay with the Retry-After header.
+BACKOFF_FACTOR = 0.5
+BACKOFF_MAX = 60
+# Responses that are worth retrying: throttling and transient server errors
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class ConfluenceRetry(Retry):
+    """
+    The retry policy of the requests to Confluence. Requests that are not idempotent
+    (eg: creating a page) are only retried when they were throttled, as they may have
+    been processed before a server error. Every retry is logged and counted.
+    """
+
+    def _is_method_retryable(
+        self, method: str, status_code: Optional[int] = None
+    ) -> bool:
+        # Throttled requests were not processed, so they can be retried whatever their
+        # method. Other failures (eg: a dropped connection or a server error) are only
+        # retried for the idempotent methods (see `allowed_methods`).
+        return status_code == 429 or super()._is_method_retryable(method)
+
+    def is_retry(
+        self, method: str, status_code: int, has_retry_after: bool = False
+    ) -> bool:
+        # Same as `Retry.is_retry`, with the status given to `_is_method_retryable`
+        if not self._is_method_retryable(method, status_code):
+            return False
+        if self.status_forcelist and status_code in self.status_forcelist:
+            return True
+        return bool(
+            self.total
+            and self.respect_retry_after_header
+            and has_retry_after
+            and status_code in self.RETRY_AFTER_STATUS_CODES
+        )
+
+    def increment(self, method=None, url=None, response=None, error=None, **kwargs):
+        retry = super().increment(method, url, response, error, **kwargs)
+        if response is None or response.status >= 400:  # Not a redirect
+            reason = response.status if response is not None else error
+            logging.warning(f"Retrying {method} {url} after: {reason}")
+            profiling.count("http_retries")
+        return retry
+
+
+@contextlib.contextmanager
+def confluence_session(
+    confluence_domain,
+    confluence_path,
+    confluence_space,
+    confluence_username,
+    confluence_apikey,
+    pool_size: int = 1,
+    max_retries: Optional[int] = None,
+) -> Iterator[ConfluenceSession]:
+    """
+    Opens a session to Confluence that keeps up to `pool_size` connections alive, to be
+    reused across requests (and threads), and retries the requests that are throttled
+    or fail with a transient server error up to `max_retries` (MAX_RETRIES by default)
+    times, with an exponential backoff. The requests are reported to the profiling collectors.
+    """
+    with ConfluenceAPI(
+        domain=confluence_domain,
+        base_path=confluence_path,
+        space_key=confluence_space,
+        user_name=confluence_username,
+        api_key=confluence_apikey,
+    ) as session:
+        retry = ConfluenceRetry(
+            total=max_retries if max_retries is not None else MAX_RETRIES,
+            status_forcelist=RETRY_STATUSES,
+            backoff_factor=BACKOFF_FACTOR,
+            backoff_max=BACKOFF_MAX,
+            # Return the last response once out of retries, so that it is reported
+            # like any other error response
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(1, pool_size), max_retries=retry
+        )
+        session.session.mount("https://", adapter)
+        session.session.hooks["response"].append(profiling.http_response_hook)
+        yield session
+
+
+def session_or_new(
+    session: Optional[ConfluenceSession], *args, **kwargs
+) -> contextlib.AbstractContextManager:
+    """
+    Returns a context yielding the given session, or a new session (see
+    `confluence_session`) if there is none.
+    """
+    if session is not None:
+        return contextlib.nullcontext(session)
+    return confluence_session(*args, **kwargs)
@@ -0,0 +1,76 @@
+import os
+import secrets
+import stat
+
+from pathlib import Path
+from typing import Dict
+
+from . import profiling
+
+# A set of markdown documents kept in memory: a mapping of each document's path,
+# relative to the root folder of the set, to its text. The mapping is ordered the same
+# way as the files of a directory would be walked by os.walk.
+DocumentSet = Dict[str, str]
+
+
+def read_documents(markdowns_dir) -> DocumentSet:
+    """
+    Reads all the files under the given directory into a document set.
+    """
+    documents = {}
+    for root, _dirs, files in os.walk(markdowns_dir):
+        for file in files:
+            file_path = os.path.join(root, file)
+            with open(file_path, "r") as f:
+                text = f.read()
+            profiling.count_bytes("bytes_read", text)
+            documents[str(Path(file_path).relative_to(markdowns_dir))] = text
+    return documents
+
+
+def write_documents(documents: DocumentSet, results_dir) -> int:
+    """
+    Saves each document of the set to the results directory, at its relative path (see
+    `write_document`). Returns the number of files written.
+    """
+    written = 0
+    for path, text in documents.items():
+        written += write_document(results_dir, path, text)
+    return written
+
+
+def write_document(results_dir, path: str, text: str) -> bool:
+    """
+    Saves a single document to the results directory, at the given relative path, if
+    the file there does not already have the same contents, so that unchanged files
+    keep their modification time. The document is written to a temporary file that is
+    then renamed over the result, so that readers never see a partially written file.
+    Returns True if the file was written.
+    """
+    result_path = os.path.join(results_dir, path)
+    data = text.encode()
+    try:
+        result_stat = os.stat(result_path)
+        if result_stat.st_size == len(data):
+            with open(result_path, "rb") as f:
+                if f.read() == data:
+                    return False
+    except OSError:
+        result_stat = None
+
+    result_dir, name = os.path.split(result_path)
+    os.makedirs(result_dir, exist_ok=True)
+    temp_path = os.path.join(result_dir, f".{name}.{secrets.token_hex(4)}.tmp")
+    try:
+        # Created with the default permissions, as `open` would
+        with open(temp_path, "xb") as f:
+            f.write(data)
+        if result_stat is not None:
+            os.chmod(temp_path, stat.S_IMODE(result_stat.st_mode))
+        os.replace(temp_path, result_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    profiling.count_bytes("bytes_written", data)
+    return True
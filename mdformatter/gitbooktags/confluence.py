@@ -1,10 +1,16 @@
-import os
+from typing import Container, Dict, Tuple
 
 from jinja2 import nodes
 from jinja2.ext import Extension
 from jinja2_simple_tags import ContainerTag, StandaloneTag
+from md2conf.converter import DocumentError
 
-from ..confluence.api import parse_page_id, parse_page_title
+from ..documents import DocumentSet
+from .pagerefs import (
+    find_broken_page_references,
+    find_page_references,
+    resolve_page_reference,
+)
 
 
 # This extension is written from scratch because the ContainerTag expects
@@ -94,14 +100,10 @@ class PageRefTagExtension(StandaloneTag):
         current_file_path = self.context["file_path"]
 
         # Get the page_id of the referenced page
-        page_path = os.path.join(os.path.dirname(current_file_path), page)
-        text = ""
-        with open(page_path, "r") as f:
-            text = f.read()
+        page_path = resolve_page_reference(current_file_path, page)
+        page_id, page_title = self.context["page_index"][page_path]
 
         # Generate link
-        page_id = parse_page_id(text)
-        page_title = parse_page_title(text)
         additional_context = self.context["additional_context"]
         domain, path, space = (
             additional_context["confluence_domain"],
@@ -109,3 +111,30 @@ class PageRefTagExtension(StandaloneTag):
             additional_context["confluence_space"],
         )
         return f"[{page_title}](https://{domain}{path}spaces/{space}/pages/{page_id})"
+
+
+def page_reference_dependencies(
+    documents: DocumentSet, page_index: Dict[str, Tuple[str, str]]
+) -> Dict[str, Dict[str, Tuple[str, str]]]:
+    """
+    Returns a map of each document's path to the page id and title of each of the pages
+    it references, by their path. A document only needs to be substituted again if
+    these change.
+    """
+    return {
+        path: {
+            page_path: page_index.get(page_path)
+            for page_path in find_page_references(path, text)
+        }
+        for path, text in documents.items()
+    }
+
+
+def check_page_references(documents: DocumentSet, page_paths: Container[str]) -> None:
+    """
+    Raises a DocumentError listing all the page references in the documents that are
+    not among the given page paths (eg: the keys of a page index or document set).
+    """
+    missing = find_broken_page_references(documents, page_paths)
+    if missing:
+        raise DocumentError(f"Referenced pages not found: {missing}")
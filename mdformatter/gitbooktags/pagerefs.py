@@ -0,0 +1,42 @@
+import os
+import re
+
+from typing import Container, List
+
+from ..documents import DocumentSet
+
+# Page references with a literal page path, with or without the "-" in the tag name
+PAGE_REF_PATTERN = re.compile(r"""{%-?\s*page-?ref\s+page\s*=\s*(["'])(.*?)\1""")
+
+
+def resolve_page_reference(file_path: str, page: str) -> str:
+    """
+    Returns the normalized path of the page referenced from the given file.
+    """
+    return os.path.normpath(os.path.join(os.path.dirname(file_path), page))
+
+
+def find_page_references(file_path: str, text: str) -> List[str]:
+    """
+    Returns the normalized paths of the pages referenced by the page-ref tags in the
+    given text. References to pages that are not a literal string are ignored.
+    """
+    return [
+        resolve_page_reference(file_path, match.group(2))
+        for match in PAGE_REF_PATTERN.finditer(text)
+    ]
+
+
+def find_broken_page_references(
+    documents: DocumentSet, page_paths: Container[str]
+) -> List[str]:
+    """
+    Returns all the page references in the documents that are not among the given page
+    paths (eg: the keys of a page index or document set), as "<path> -> <page path>".
+    """
+    return [
+        f"{path} -> {page_path}"
+        for path, text in documents.items()
+        for page_path in find_page_references(path, text)
+        if page_path not in page_paths
+    ]
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+
+from typing import Dict, Iterable, List, Optional
+
+from . import __version__
+
+
+class Manifest:
+    """
+    Records, for each output file, the digests of the inputs it was built from so that
+    subsequent runs can skip the files whose inputs did not change.
+
+    The inputs of an output are its template, its override, the tool version and the
+    run options (captured by the `inputs` digest), plus the values of the variables
+    that the template actually references. The templates that it loaded (eg: included
+    partials, see `PartialsLoader`) are recorded as well, as the edges of a dependency
+    graph, so that it can be built again when one of them changes (see
+    `templates_digest`).
+    """
+
+    def __init__(
+        self, path: Optional[str] = None, outputs: Optional[Dict] = None
+    ) -> None:
+        self.path = path
+        self.outputs = outputs or {}  # relative output path -> entry
+
+    @classmethod
+    def load(cls, path: str) -> "Manifest":
+        """
+        Reads the manifest at the given path. A missing manifest, or one written by a
+        different version of the tool, results in an empty manifest.
+        """
+        outputs = {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data.get("version") == __version__:
+                outputs = data["outputs"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return cls(path, outputs)
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"version": __version__, "outputs": self.outputs}, f)
+
+    def select_stale(
+        self,
+        results_dir,
+        inputs: Dict[str, str],
+        values: Dict,
+        removed_paths: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Removes the outputs that are no longer built and returns the paths of the
+        outputs that need to be built again.
+
+        Parameters
+        ----------
+        results_dir: str
+            Path to the folder where the outputs are stored
+        inputs: Dict[str, str]
+            Map of the path of each output, relative to the results directory, to the
+            digest of its inputs
+        values: Dict
+            The values to be applied to the variables in the templates
+        removed_paths: List[str], optional
+            If provided, the paths of the removed outputs are added to it
+        """
+        removed = self.remove_stale(results_dir, inputs)
+        if removed_paths is not None:
+            removed_paths.extend(removed)
+        stale_paths = [
+            output_path
+            for output_path in inputs
+            if not self.is_up_to_date(
+                output_path,
+                os.path.join(results_dir, output_path),
+                inputs[output_path],
+                values,
+            )
+        ]
+        logging.info(
+            f"{len(inputs) - len(stale_paths)} of {len(inputs)} files are up to date"
+        )
+        return stale_paths
+
+    def is_up_to_date(
+        self, output_path: str, result_path: str, inputs: str, values: Dict
+    ) -> bool:
+        """
+        Returns True if the output was built from the same inputs and values, and has
+        not been modified since.
+
+        Parameters
+        ----------
+        output_path: str
+            Path of the output, relative to the results directory
+        result_path: str
+            Path of the output on disk
+        inputs: str
+            Digest of the inputs of the output (see `digest`)
+        values: Dict
+            The values to be applied to the variables in the templates
+        """
+        entry = self.outputs.get(output_path)
+        if entry is None or entry["inputs"] != inputs:
+            return False
+        if entry["values"] != _values_digest(entry["variables"], values):
+            return False
+        try:
+            stat = os.stat(result_path)
+        except OSError:
+            return False
+        return entry["output"] == [stat.st_size, stat.st_mtime_ns]
+
+    def record(
+        self,
+        output_path: str,
+        result_path: str,
+        inputs: str,
+        variables: Iterable[str],
+        values: Dict,
+        templates: Iterable[str] = (),
+    ) -> None:
+        """
+        Records the inputs of an output that has just been built, and the templates it
+        loaded, if any.
+        """
+        variables = sorted(variables)
+        stat = os.stat(result_path)
+        self.outputs[output_path] = {
+            "inputs": inputs,
+            "variables": variables,
+            "values": _values_digest(variables, values),
+            "output": [stat.st_size, stat.st_mtime_ns],
+        }
+        if templates:
+            self.outputs[output_path]["templates"] = sorted(templates)
+
+    def templates(self, output_path: str) -> List[str]:
+        """
+        Returns the names of the templates that the output loaded when it was last
+        built (eg: included partials).
+        """
+        return self.outputs.get(output_path, {}).get("templates", [])
+
+    def dependents(self, template: str) -> List[str]:
+        """
+        Returns the paths of the outputs that loaded the given template when they were
+        last built, i.e., those to be built again when it changes.
+        """
+        return sorted(
+            output_path
+            for output_path, entry in self.outputs.items()
+            if template in entry.get("templates", [])
+        )
+
+    def remove_stale(self, results_dir, output_paths: Iterable[str]) -> List[str]:
+        """
+        Deletes the outputs that are no longer built (i.e., their template was
+        deleted) from the results directory, forgets them and returns their paths.
+        """
+        removed = sorted(set(self.outputs) - set(output_paths))
+        for output_path in removed:
+            result_path = os.path.join(results_dir, output_path)
+            if os.path.exists(result_path):
+                logging.info(f"Removing {result_path}")
+                os.remove(result_path)
+            del self.outputs[output_path]
+        return removed
+
+
+def manifest_path(cache_dir, results_dir) -> str:
+    """
+    Returns the path of the manifest for the given results directory. Each results
+    directory has its own manifest so that a cache directory can be shared.
+    """
+    key = hashlib.sha256(os.path.abspath(results_dir).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "manifests", f"{key}.json")
+
+
+def digest(*parts) -> str:
+    """
+    Returns a digest of the given parts. Each part can be bytes, a string, None or any
+    JSON serializable value.
+    """
+    h = hashlib.sha256()
+    for part in parts:
+        if part is None:
+            data = b"\0"
+        elif isinstance(part, bytes):
+            data = b"b" + part
+        elif isinstance(part, str):
+            data = b"s" + part.encode()
+        else:
+            data = b"j" + json.dumps(part, sort_keys=True, default=str).encode()
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def _values_digest(variables: Iterable[str], values: Dict) -> str:
+    # Variables missing from the values are left out, so that adding them later
+    # changes the digest.
+    return digest({name: values[name] for name in variables if name in values})
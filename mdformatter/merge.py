@@ -1,13 +1,49 @@
-from collections import OrderedDict
-from typing import Dict, List
+from typing import Dict, Iterator, List, Optional, TextIO, Tuple
 import re
 
+# A heading: one or more "#" at the start of the line, followed by a whitespace
+HEADING_PATTERN = re.compile(r"(#+)\s")
+# A code fence: at least three backticks or tildes, indented by up to three spaces,
+# followed by an optional info string
+FENCE_PATTERN = re.compile(r" {0,3}(`{3,}|~{3,})")
+# The closing fence of a code block: a fence with no info string
+CLOSING_FENCE_PATTERN = re.compile(r" {0,3}(`{3,}|~{3,})\s*$")
+# Any character that makes a line non-empty
+NON_EMPTY_LINE_PATTERN = re.compile(r"[^\n]")
+
 
 class MarkDownContent:
-    def __init__(self, level=0) -> None:
+    """
+    A section of a markdown document: its lines (up to its first subsection) and its
+    subsections, by their heading.
+
+    The lines are not stored individually; instead, the section refers to the span of
+    the source text that they occupy, so that parsing and merging do not copy the text.
+    """
+
+    __slots__ = ("level", "source", "span", "subsections")
+
+    def __init__(
+        self, level=0, source: str = "", span: Optional[Tuple[int, int]] = None
+    ) -> None:
         self.level = level  # Heading level
-        self.lines = []  # Newline separated lines
-        self.subsections = OrderedDict()  # string -> MarkDownContent
+        self.source = source  # Text containing the lines
+        self.span = span  # (start, end) offsets of the lines in the source, if any
+        self.subsections = {}  # string -> MarkDownContent
+
+    @property
+    def lines(self) -> List[str]:
+        """
+        Newline separated lines
+        """
+        if self.span is None:
+            return []
+        return self.source[self.span[0] : self.span[1]].split("\n")
+
+    @lines.setter
+    def lines(self, lines: List[str]) -> None:
+        self.source = "\n".join(lines)
+        self.span = (0, len(self.source)) if lines else None
 
     def to_text(self, delimiter="\n") -> str:
         """
@@ -23,18 +59,41 @@ class MarkDownContent:
         -------
         String representation of the markdown contents
         """
-        subsections_text = []
-        for heading in self.subsections:
-            subsections_text.append(
-                heading + delimiter + self.subsections[heading].to_text()
-            )
+        return "".join(self.iter_text(delimiter))
+
+    def iter_text(self, delimiter="\n") -> Iterator[str]:
+        """
+        Yields the string representation of the markdown content (see `to_text`) in
+        chunks, in document order, without building the intermediate text of each
+        subsection.
 
-        content = delimiter.join(self.lines)
-        if len(self.lines) > 0 and len(self.subsections) > 0:
-            content += delimiter
-        content += delimiter.join(subsections_text)
+        Parameters
+        ----------
+        delimiter: str, default "\n"
+            The delimiter to use, to join the individual lines of the markdown.
+        """
+        if delimiter == "\n":
+            yield self._text()
+        else:
+            yield delimiter.join(self.lines)
+        if self.span is not None and len(self.subsections) > 0:
+            yield delimiter
 
-        return content
+        for i, heading in enumerate(self.subsections):
+            if i > 0:
+                yield delimiter
+            yield heading
+            yield delimiter
+            # Subsections are always joined with the default delimiter
+            yield from self.subsections[heading].iter_text()
+
+    def write_to(self, fp: TextIO, delimiter="\n") -> None:
+        """
+        Writes the string representation of the markdown content (see `to_text`) to
+        the given file object, chunk by chunk.
+        """
+        for chunk in self.iter_text(delimiter):
+            fp.write(chunk)
 
     def to_dict(self) -> Dict:
         """
@@ -54,13 +113,25 @@ class MarkDownContent:
         """
         Returns True if the object has at least one line that is not empty.
         """
-        return len([x for x in self.lines if x != ""]) > 0
+        if self.span is None:
+            return False
+        return NON_EMPTY_LINE_PATTERN.search(self.source, *self.span) is not None
+
+    def _text(self) -> str:
+        # The lines, joined by newlines
+        if self.span is None:
+            return ""
+        return self.source[self.span[0] : self.span[1]]
 
 
 def parse_markdown(text, delimiter="\n") -> MarkDownContent:
     """
     Parses the markdown into sections by their heading.
 
+    Lines starting with one or more "#" followed by a whitespace are headings, except
+    inside fenced code blocks (eg: shell comments in a code sample). Indented code
+    blocks cannot contain such lines as they are always indented.
+
     Parameters
     ----------
     text: str
@@ -72,35 +143,53 @@ def parse_markdown(text, delimiter="\n") -> MarkDownContent:
     -------
     A recursive representation of headings and contents (MarkDownContent)
     """
-    lines = text.split("\n")
-    _, parsed_markdown = _parse_markdown_recursive(lines, 0, MarkDownContent())
-    return parsed_markdown
+    parsed_markdown = MarkDownContent(source=text)
+    sections = [parsed_markdown]  # The current section and its ancestors
+    lines_start = 0  # Offset of the first line of the current section
+    fence = None  # The opening fence of the current code block, if any
 
+    start = 0  # Offset of the current line
+    while True:
+        end = text.find("\n", start)
+        if end == -1:
+            end = len(text)
 
-def _parse_markdown_recursive(
-    lines: List[str], index: int, markdown: MarkDownContent
-) -> (int, MarkDownContent):
-    while index < len(lines):
-        line = lines[index]
-        if line.startswith("#"):
-            match = re.search("^(#+)\s.*", line)
-            new_heading_level = len(match.group(1))
-            if new_heading_level > markdown.level:
-                new_index, subsection = _parse_markdown_recursive(
-                    lines,
-                    index + 1,
-                    MarkDownContent(level=new_heading_level),
-                )
-                markdown.subsections[line] = subsection
-                index = new_index
-            else:
-                # Same heading level or higher, need to unfold
-                return index, markdown
+        if fence is not None:
+            match = CLOSING_FENCE_PATTERN.match(text, start, end)
+            if (
+                match
+                and match.group(1)[0] == fence[0]
+                and len(match.group(1)) >= len(fence)
+            ):
+                fence = None
+        elif HEADING_PATTERN.match(text, start, end):
+            _set_span(sections[-1], lines_start, start)
+
+            # The heading belongs to the closest section with a lower level
+            level = len(HEADING_PATTERN.match(text, start, end).group(1))
+            while sections[-1].level >= level:
+                sections.pop()
+            section = MarkDownContent(level=level, source=text)
+            sections[-1].subsections[text[start:end]] = section
+            sections.append(section)
+            lines_start = end + 1
         else:
-            markdown.lines.append(line)
-            index += 1
-    # End of lines
-    return index, markdown
+            match = FENCE_PATTERN.match(text, start, end)
+            if match:
+                fence = match.group(1)
+
+        if end == len(text):
+            break
+        start = end + 1
+
+    _set_span(sections[-1], lines_start, len(text) + 1)
+    return parsed_markdown
+
+
+def _set_span(section: MarkDownContent, lines_start: int, next_line_start: int) -> None:
+    # The lines of the section end right before the newline preceding the next line
+    if next_line_start > lines_start:
+        section.span = (lines_start, next_line_start - 1)
 
 
 def merge_markdowns(base, *args):
@@ -119,39 +208,59 @@ def merge_markdowns(base, *args):
     str
         Merged markdown contents
     """
+    return merge_markdown_contents(base, *args).to_text()
 
-    if len(args) < 1:
-        raise ValueError("Must provide at least one override markdown text")
 
-    # Read base markdown
-    merged_content = parse_markdown(base)
+def merge_markdown_contents(base, *args) -> MarkDownContent:
+    """
+    Same as `merge_markdowns`, but returns the merged contents without serializing
+    them, so that they can be streamed (see `MarkDownContent.iter_text` and
+    `MarkDownContent.write_to`).
+    """
 
-    # Merge overrides
-    for override in args:
-        override_content = parse_markdown(override)
-        merged_content = _merge_markdowns_recursive(merged_content, override_content)
+    if len(args) < 1:
+        raise ValueError("Must provide at least one override markdown text")
 
-    return merged_content.to_text()
+    # Read all the markdowns and merge the overrides, all at once
+    return _merge_markdowns_recursive(
+        parse_markdown(base), [parse_markdown(override) for override in args]
+    )
 
 
 def _merge_markdowns_recursive(
-    base: MarkDownContent, override: MarkDownContent
+    base: MarkDownContent, overrides: List[MarkDownContent]
 ) -> MarkDownContent:
-    if base.level != override.level:
-        return base
+    # Merges the overrides onto the base in a single traversal. The result is the same
+    # as merging each override in turn, the latter ones taking precedence.
+    overrides = [override for override in overrides if override.level == base.level]
 
-    if override.has_lines():
-        base.lines = override.lines
+    for override in overrides:
+        if override.has_lines():
+            # Refer to the lines of the override rather than copying them
+            base.source, base.span = override.source, override.span
 
     for heading in base.subsections:
-        if heading in override.subsections:
+        section_overrides = [
+            override.subsections[heading]
+            for override in overrides
+            if heading in override.subsections
+        ]
+        if section_overrides:
             base.subsections[heading] = _merge_markdowns_recursive(
-                base.subsections[heading], override.subsections[heading]
+                base.subsections[heading], section_overrides
             )
 
-    # Copy excess sections from the overrides
-    for heading in override.subsections:
-        if heading not in base.subsections:
-            base.subsections[heading] = override.subsections[heading]
+    # Copy excess sections from the overrides, merging in those of the later overrides
+    for i, override in enumerate(overrides):
+        for heading in override.subsections:
+            if heading not in base.subsections:
+                base.subsections[heading] = _merge_markdowns_recursive(
+                    override.subsections[heading],
+                    [
+                        later.subsections[heading]
+                        for later in overrides[i + 1 :]
+                        if heading in later.subsections
+                    ],
+                )
 
     return base
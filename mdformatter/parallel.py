@@ -0,0 +1,57 @@
+import functools
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Sequence, Tuple, TypeVar
+
+from . import profiling
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def map_files(func: Callable[[T], R], items: Sequence[T], jobs: int = 1) -> List[R]:
+    """
+    Applies the given function to each of the items and returns the results in the same
+    order as the items. When more than one job is requested, the items are distributed
+    over a pool of worker processes; otherwise, they are processed serially in the
+    current process.
+
+    Parameters
+    ----------
+    func: Callable
+        A picklable function (eg: a module-level function or a functools.partial of one)
+        that processes a single item.
+    items: Sequence
+        The items to be processed, typically file paths.
+    jobs: int, default 1
+        The maximum number of worker processes to use.
+
+    Returns
+    -------
+    The list of results, one per item.
+    """
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    # Hand out the items in chunks so that the (potentially large) arguments bound to
+    # the function are not pickled once per item.
+    chunksize = max(1, len(items) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=min(jobs, len(items))) as executor:
+        if not profiling.collecting():
+            return list(executor.map(func, items, chunksize=chunksize))
+
+        # The timings reported in the workers are sent back to the collectors of this
+        # process along with the results.
+        results = []
+        for result, events in executor.map(
+            functools.partial(_recorded, func), items, chunksize=chunksize
+        ):
+            profiling.replay(events)
+            results.append(result)
+        return results
+
+
+def _recorded(func: Callable[[T], R], item: T) -> Tuple[R, List]:
+    with profiling.recording() as recorder:
+        result = func(item)
+    return result, recorder.events
@@ -0,0 +1,149 @@
+import os
+
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from jinja2 import BaseLoader, Environment, TemplateNotFound
+from jinja2.loaders import split_template_path
+
+from . import profiling
+from .archives import is_archive, read_archive
+from .documents import DocumentSet
+from .manifest import digest
+from .merge import merge_markdowns
+
+
+class PartialsLoader(BaseLoader):
+    """
+    Loads the templates included or imported by others (eg: `{% include "support.md"
+    %}`), by their path relative to the root of the partials folder. Like any template,
+    they are merged with their overrides in each of the override layers of the
+    partials folder.
+
+    The loaded templates are cached by their Jinja environment for the whole run, and
+    loaded again when the modification time or size of any of their files changes (or
+    of the archive containing it, see `is_archive`).
+
+    Parameters
+    ----------
+    partials_dirs: Sequence[str]
+        The partials folder, followed by its override folders (layers), in which case
+        the overrides of the latter layers take precedence
+    prepare: Callable[[str], str], optional
+        Applied to the merged text of the templates before they are parsed (eg:
+        `prepare_text`)
+    """
+
+    def __init__(
+        self,
+        partials_dirs: Sequence[str],
+        prepare: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        self.partials_dirs = list(partials_dirs)
+        self.prepare = prepare
+        self._archives = {}  # path -> (modification time and size, DocumentSet)
+        self._digests = {}  # template -> (modification times and sizes, digest)
+
+    def get_source(
+        self, environment: Environment, template: str
+    ) -> Tuple[str, str, Callable[[], bool]]:
+        path = os.path.join(*split_template_path(template))
+        stats = self._stats(path)
+        texts = self._read(path)
+        if not texts or texts[0] is None:
+            raise TemplateNotFound(template)
+
+        with profiling.span(path, profiling.FILE, stage="merge"):
+            text = texts[0]
+            overrides = [override for override in texts[1:] if override is not None]
+            if overrides:
+                text = merge_markdowns(text, *overrides)
+        if self.prepare is not None:
+            text = self.prepare(text)
+        return (
+            text,
+            os.path.join(self.partials_dirs[0], path),
+            lambda: self._stats(path) == stats,
+        )
+
+    def digest(self, template: str) -> Optional[str]:
+        """
+        Returns the digest of the files of the given template (see `get_source`), or
+        None if there is no such template.
+        """
+        try:
+            path = os.path.join(*split_template_path(template))
+        except TemplateNotFound:  # Eg: the name is a path outside of the folders
+            return None
+        stats = self._stats(path)
+        if template not in self._digests or self._digests[template][0] != stats:
+            texts = self._read(path)
+            self._digests[template] = (
+                stats,
+                digest(*texts) if texts and texts[0] is not None else None,
+            )
+        return self._digests[template][1]
+
+    def exists(self, template: str) -> bool:
+        """
+        Returns whether there is a template with the given name (see `get_source`).
+        """
+        return self.digest(template) is not None
+
+    def _read(self, path: str) -> List[Optional[str]]:
+        # The text of the file at the given path in each folder, or None if the folder
+        # does not have one
+        texts = []
+        for partials_dir in self.partials_dirs:
+            if is_archive(partials_dir):
+                texts.append(self._read_archive(partials_dir).get(path))
+                continue
+            try:
+                with open(os.path.join(partials_dir, path)) as f:
+                    texts.append(f.read())
+            except FileNotFoundError:
+                texts.append(None)
+                continue
+            profiling.count_bytes("bytes_read", texts[-1])
+        return texts
+
+    def _read_archive(self, path: str) -> DocumentSet:
+        # Archives are read whole (once, unless they change), as they cannot be read
+        # one file at a time
+        stat = _stat(path)
+        if path not in self._archives or self._archives[path][0] != stat:
+            self._archives[path] = (stat, read_archive(path))
+        return self._archives[path][1]
+
+    def _stats(self, path: str) -> List[Optional[Tuple[int, int]]]:
+        return [
+            _stat(
+                partials_dir
+                if is_archive(partials_dir)
+                else os.path.join(partials_dir, path)
+            )
+            for partials_dir in self.partials_dirs
+        ]
+
+
+def templates_digest(
+    inputs: str, templates: Sequence[str], loader: PartialsLoader
+) -> str:
+    """
+    Returns the digest of the inputs of an output combined with those of the templates
+    it loaded when it was built (eg: included ones, see `PartialsLoader`), so that it is
+    built again when any of them changes. The digest is unchanged if there are none.
+    """
+    if not templates:
+        return inputs
+    return digest(
+        inputs, {template: loader.digest(template) for template in sorted(templates)}
+    )
+
+
+def _stat(path: str) -> Optional[Tuple[int, int]]:
+    # The modification time and size of the file, or None if it does not exist
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
@@ -0,0 +1,582 @@
+import functools
+import logging
+import os
+
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+from . import profiling
+from .archives import is_archive, read_archive, write_archive
+from .documents import DocumentSet, read_documents, write_document, write_documents
+from .manifest import Manifest, digest
+from .merge import merge_markdowns
+from .parallel import map_files
+from .partials import PartialsLoader, templates_digest
+from .substitute import (
+    OutputFormat,
+    compile_text,
+    render_template,
+    substitute_documents,
+    substitute_text,
+)
+
+
+def list_templates(templates_dir) -> List[str]:
+    """
+    Returns the paths of all the files under the templates directory, relative to it.
+    """
+    template_paths = []
+    for root, _dirs, files in os.walk(templates_dir):
+        for file in files:
+            template_paths.append(
+                str(Path(os.path.join(root, file)).relative_to(templates_dir))
+            )
+    return template_paths
+
+
+def override_layers(overrides_dir: Union[str, Sequence[str]]) -> List[str]:
+    """
+    Returns the given overrides directory, or list of directories (layers), as a list.
+    """
+    if isinstance(overrides_dir, (str, os.PathLike)):
+        return [overrides_dir]
+    return list(overrides_dir)
+
+
+def index_overrides(overrides_dirs: Sequence[str]) -> Dict[str, List[str]]:
+    """
+    Returns a map of the relative path of every override to the paths of the override
+    files in each of the override directories that has one, in the same order as the
+    directories. Each directory is scanned once.
+    """
+    overrides = {}
+    for overrides_dir in overrides_dirs:
+        for override_path in list_templates(overrides_dir):
+            overrides.setdefault(override_path, []).append(
+                os.path.join(overrides_dir, override_path)
+            )
+    return overrides
+
+
+def load_documents(
+    templates_dir, overrides_dir: Union[str, Sequence[str]], jobs: int = 1
+) -> DocumentSet:
+    """
+    Merges every template with its overrides (if any) and returns the results as a
+    document set, with the same relative paths as the templates. Files are processed
+    independently of each other, using up to `jobs` worker processes.
+
+    The overrides can be given as a single directory or as a list of directories
+    (layers), in which case the overrides of the latter layers take precedence. The
+    templates and overrides directories can also be archives (see `is_archive`), which
+    are read into memory without being extracted.
+    """
+    overrides_dirs = override_layers(overrides_dir)
+    if any(map(is_archive, [templates_dir, *overrides_dirs])):
+        templates = read_tree(templates_dir)
+        overrides = [read_tree(overrides_dir) for overrides_dir in overrides_dirs]
+        merged = map_files(
+            _merge_document,
+            [
+                (path, text, [layer[path] for layer in overrides if path in layer])
+                for path, text in templates.items()
+            ],
+            jobs=jobs,
+        )
+        return dict(zip(templates, merged))
+
+    template_paths = list_templates(templates_dir)
+    overrides = index_overrides(overrides_dirs)
+    merged = map_files(
+        functools.partial(_read_merged, templates_dir=templates_dir),
+        [
+            (template_path, overrides.get(template_path, []))
+            for template_path in template_paths
+        ],
+        jobs=jobs,
+    )
+    return dict(zip(template_paths, merged))
+
+
+def read_tree(path) -> DocumentSet:
+    """
+    Reads all the files of the given directory or archive into a document set.
+    """
+    if is_archive(path):
+        return read_archive(path)
+    return read_documents(path)
+
+
+def format_templates(
+    templates_dir,
+    overrides_dir: Union[str, Sequence[str]],
+    results_dir,
+    input: Dict,
+    output_format: OutputFormat,
+    additional_context: Dict,
+    jobs: int = 1,
+    manifest: Optional[Manifest] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+) -> Dict[str, int]:
+    """
+    Merges every template with its overrides (if any, see `load_documents`),
+    substitutes its variables and saves the result to the results directory. Each file
+    goes through all the steps on its own, using up to `jobs` worker processes.
+
+    This can only be used when the substitution of a file does not depend on the
+    other merged files (i.e., it cannot be used for the CONFLUENCE output format,
+    which requires all the pages to be preprocessed first).
+
+    If a manifest is provided, the files whose inputs did not change since the
+    manifest was last saved are skipped, the outputs of deleted templates are removed
+    and the manifest is updated and saved. The inputs of a file include the templates
+    it includes or imports from the partials folders, if any (see `PartialsLoader`).
+    If a bytecode cache directory is provided, the compiled templates are cached there
+    across runs.
+
+    Only the results whose contents changed are written (see `write_document`).
+    Returns the number of results written, unchanged and removed (see
+    `report_results`).
+    """
+    template_paths = list_templates(templates_dir)
+    overrides_dirs = override_layers(overrides_dir)
+    overrides = index_overrides(overrides_dirs)
+
+    stale_paths, removed_paths = template_paths, []
+    if manifest is not None:
+        loader = PartialsLoader(partials_dirs or [])
+        inputs = {
+            template_path: _inputs_digest(
+                template_path,
+                templates_dir,
+                overrides_dirs,
+                overrides.get(template_path, []),
+                output_format,
+                additional_context,
+            )
+            for template_path in template_paths
+        }
+        stale_paths = manifest.select_stale(
+            results_dir,
+            _with_templates(inputs, manifest, loader),
+            input,
+            removed_paths=removed_paths,
+        )
+
+    results = map_files(
+        functools.partial(
+            _format_file,
+            templates_dir=templates_dir,
+            results_dir=results_dir,
+            input=input,
+            output_format=output_format,
+            additional_context=additional_context,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+        ),
+        [
+            (template_path, overrides.get(template_path, []))
+            for template_path in stale_paths
+        ],
+        jobs=jobs,
+    )
+
+    if manifest is not None:
+        for template_path, (referenced_variables, templates, _) in zip(
+            stale_paths, results
+        ):
+            manifest.record(
+                template_path,
+                os.path.join(results_dir, template_path),
+                templates_digest(inputs[template_path], templates, loader),
+                referenced_variables,
+                input,
+                templates=templates,
+            )
+        manifest.save()
+
+    written = sum(written for _, _, written in results)
+    return report_results(written, len(template_paths) - written, len(removed_paths))
+
+
+def render_documents(
+    documents: DocumentSet,
+    results_dir,
+    input: Dict,
+    output_format: OutputFormat,
+    additional_context: Dict,
+    jobs: int = 1,
+    manifest: Optional[Manifest] = None,
+    dependencies: Optional[Dict[str, object]] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+) -> Dict[str, int]:
+    """
+    Substitutes the variables of the documents and saves each of them to the results
+    directory, at its relative path. Documents are processed independently of each
+    other, using up to `jobs` worker processes.
+
+    If a manifest is provided, the documents that did not change since the manifest was
+    last saved are skipped, the outputs of deleted documents are removed and the
+    manifest is updated and saved. Only the results whose contents changed are
+    written. Returns the number of results written, unchanged and removed (see
+    `report_results`).
+
+    The results directory can also be an archive (see `is_archive`), in which case
+    the manifest is not used.
+
+    Parameters
+    ----------
+    dependencies: Dict[str, object], optional
+        Map of a document's path to any JSON serializable input that it depends on,
+        besides its own text (eg: the pages it references). A change in it invalidates
+        the document in the manifest.
+    bytecode_cache_dir: str, optional
+        Path to the folder where the compiled templates should be cached across runs
+    partials_dirs: Sequence[str], optional
+        The partials folder followed by its override folders, from which the templates
+        included or imported by the documents are loaded (see `PartialsLoader`). They
+        are part of the inputs of the documents that load them, in the manifest.
+    """
+    if is_archive(results_dir):
+        # The archive is written in a single pass, so all the documents are rendered
+        # and compared with those of the previous archive instead (see `write_archive`)
+        substituted_documents = substitute_documents(
+            documents,
+            input,
+            output_format,
+            additional_context,
+            jobs=jobs,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+        )
+        return report_results(**write_archive(results_dir, substituted_documents))
+
+    stale_paths, removed_paths = list(documents), []
+    if manifest is not None:
+        loader = PartialsLoader(partials_dirs or [])
+        inputs = {
+            path: digest(
+                output_format.value,
+                additional_context,
+                text,
+                (dependencies or {}).get(path),
+            )
+            for path, text in documents.items()
+        }
+        stale_paths = manifest.select_stale(
+            results_dir,
+            _with_templates(inputs, manifest, loader),
+            input,
+            removed_paths=removed_paths,
+        )
+
+    referenced_variables, included_templates = {}, {}
+    substituted_documents = substitute_documents(
+        documents,
+        input,
+        output_format,
+        additional_context,
+        jobs=jobs,
+        paths=stale_paths,
+        referenced_variables=referenced_variables,
+        bytecode_cache_dir=bytecode_cache_dir,
+        partials_dirs=partials_dirs,
+        included_templates=included_templates,
+    )
+    written = write_documents(substituted_documents, results_dir)
+
+    if manifest is not None:
+        for path in stale_paths:
+            manifest.record(
+                path,
+                os.path.join(results_dir, path),
+                templates_digest(inputs[path], included_templates[path], loader),
+                referenced_variables[path],
+                input,
+                templates=included_templates[path],
+            )
+        manifest.save()
+
+    return report_results(written, len(documents) - written, len(removed_paths))
+
+
+def render_variants(
+    documents: DocumentSet,
+    results_dir,
+    inputs: Dict[str, Dict],
+    output_format: OutputFormat,
+    additional_context: Dict,
+    jobs: int = 1,
+    manifests: Optional[Dict[str, Manifest]] = None,
+    dependencies: Optional[Dict[str, object]] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+) -> Dict[str, int]:
+    """
+    Substitutes the variables of the documents against each of several sets of values
+    (variants, eg: one per environment) and saves the results of each variant to a
+    subfolder of the results directory, named after the variant. Each document is
+    compiled once and rendered for all the variants, using up to `jobs` worker
+    processes. Returns the number of results written, unchanged and removed, over all
+    the variants (see `report_results`).
+
+    Parameters
+    ----------
+    documents: DocumentSet
+        The merged (and for the CONFLUENCE output format, preprocessed) documents
+    results_dir: str
+        Path to the folder where the subfolder of each variant should be stored, or to
+        an archive (see `is_archive`), in which case the manifests are not used
+    inputs: Dict[str, Dict]
+        Map of the name of each variant to the values to be applied to the variables
+    manifests: Dict[str, Manifest], optional
+        Map of the name of each variant to its manifest (see `render_documents`). The
+        documents that did not change since the manifest of a variant was last saved
+        are not rendered for that variant.
+    dependencies: Dict[str, object], optional
+        See `render_documents`
+    bytecode_cache_dir: str, optional
+        Path to the folder where the compiled templates should be cached across runs
+    partials_dirs: Sequence[str], optional
+        See `render_documents`
+    """
+    page_index = None
+    if output_format == OutputFormat.CONFLUENCE:
+        from .confluence.api import page_index as build_page_index
+        from .gitbooktags.confluence import check_page_references
+
+        page_index = build_page_index(documents)
+        check_page_references(documents, page_index)
+
+    # The results are collected in memory, to be written in a single pass, if they
+    # are saved to an archive
+    archive_path = None
+    if is_archive(results_dir):
+        archive_path, results_dir, manifests = results_dir, None, None
+
+    # The variants for which each document has to be rendered
+    stale_variants = {path: [] for path in documents}
+    if manifests is not None:
+        loader = PartialsLoader(partials_dirs or [])
+        digests = {
+            path: digest(
+                output_format.value,
+                additional_context,
+                text,
+                (dependencies or {}).get(path),
+            )
+            for path, text in documents.items()
+        }
+    removed_paths = []
+    for name, input in inputs.items():
+        stale_paths = list(documents)
+        if manifests is not None:
+            stale_paths = manifests[name].select_stale(
+                os.path.join(results_dir, name),
+                _with_templates(digests, manifests[name], loader),
+                input,
+                removed_paths=removed_paths,
+            )
+        for path in stale_paths:
+            stale_variants[path].append(name)
+
+    paths = [path for path, names in stale_variants.items() if names]
+    results = map_files(
+        functools.partial(
+            _render_variants,
+            results_dir=results_dir,
+            inputs=inputs,
+            output_format=output_format,
+            additional_context=additional_context,
+            page_index=page_index,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+        ),
+        [(path, documents[path], stale_variants[path]) for path in paths],
+        jobs=jobs,
+    )
+
+    if archive_path is not None:
+        return report_results(
+            **write_archive(
+                archive_path,
+                {
+                    os.path.join(name, path): texts[name]
+                    for name in inputs
+                    for path, (_, _, _, texts) in zip(paths, results)
+                },
+            )
+        )
+
+    if manifests is not None:
+        for path, (referenced_variables, templates, _, _) in zip(paths, results):
+            for name in stale_variants[path]:
+                manifests[name].record(
+                    path,
+                    os.path.join(results_dir, name, path),
+                    templates_digest(digests[path], templates[name], loader),
+                    referenced_variables[name],
+                    inputs[name],
+                    templates=templates[name],
+                )
+        for manifest in manifests.values():
+            manifest.save()
+
+    written = sum(written for _, _, written, _ in results)
+    return report_results(
+        written, len(documents) * len(inputs) - written, len(removed_paths)
+    )
+
+
+def report_results(written: int, unchanged: int, removed: int) -> Dict[str, int]:
+    """
+    Logs and returns the number of results written, unchanged (including those skipped
+    as up to date) and removed (as their template was deleted).
+    """
+    logging.info(
+        f"{written} files written, {unchanged} unchanged and {removed} removed"
+    )
+    return {"written": written, "unchanged": unchanged, "removed": removed}
+
+
+def _render_variants(
+    document: Tuple[str, str, List[str]],
+    results_dir: Optional[str],
+    inputs: Dict[str, Dict],
+    output_format: OutputFormat,
+    additional_context: Dict,
+    page_index: Optional[Dict[str, Tuple[str, str]]],
+    bytecode_cache_dir: Optional[str],
+    partials_dirs: Optional[Sequence[str]],
+) -> Tuple[Dict[str, Set[str]], Dict[str, Set[str]], int, Dict[str, str]]:
+    # Returns the variables referenced by the document, the templates it loaded and its
+    # text for each variant, and the number of results written. The texts are only
+    # returned, not written, if there is no results folder.
+    path, text, names = document
+    logging.debug(f"Processing {path}")
+    referenced_variables, templates, written, texts = {}, {}, 0, {}
+    with profiling.span(path, profiling.FILE, stage="substitute"):
+        # The partials that the text tries to load (see `compile_text`)
+        looked_up = set()
+        tpl = compile_text(
+            text,
+            output_format,
+            bytecode_cache_dir,
+            partials_dirs,
+            included_templates=looked_up,
+        )
+        for name in names:
+            referenced_variables[name], templates[name] = set(), set(looked_up)
+            texts[name] = render_template(
+                tpl,
+                path,
+                inputs[name],
+                additional_context,
+                referenced_variables=referenced_variables[name],
+                page_index=page_index,
+                included_templates=templates[name],
+            )
+            if results_dir is not None:
+                written += write_document(
+                    os.path.join(results_dir, name), path, texts.pop(name)
+                )
+    return referenced_variables, templates, written, texts
+
+
+def _format_file(
+    template: Tuple[str, List[str]],
+    templates_dir,
+    results_dir,
+    input: Dict,
+    output_format: OutputFormat,
+    additional_context: Dict,
+    bytecode_cache_dir: Optional[str],
+    partials_dirs: Optional[Sequence[str]],
+) -> Tuple[Set[str], Set[str], bool]:
+    template_path, _override_paths = template
+    with profiling.span(template_path, profiling.FILE, stage="format"):
+        referenced_variables, templates = set(), set()
+        file_contents = _read_merged(template, templates_dir)
+        file_contents = substitute_text(
+            template_path,
+            file_contents,
+            input,
+            output_format,
+            additional_context,
+            referenced_variables=referenced_variables,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+            included_templates=templates,
+        )
+        written = write_document(results_dir, template_path, file_contents)
+    return referenced_variables, templates, written
+
+
+def _with_templates(
+    inputs: Dict[str, str], manifest: Manifest, loader: PartialsLoader
+) -> Dict[str, str]:
+    # The digests of the inputs of the outputs, combined with those of the templates
+    # that each of them loaded when it was last built (see `templates_digest`)
+    return {
+        path: templates_digest(inputs_digest, manifest.templates(path), loader)
+        for path, inputs_digest in inputs.items()
+    }
+
+
+def _inputs_digest(
+    template_path: str,
+    templates_dir,
+    overrides_dirs: Sequence[str],
+    override_paths: List[str],
+    output_format: OutputFormat,
+    additional_context: Dict,
+) -> str:
+    with open(os.path.join(templates_dir, template_path), "rb") as t:
+        template = t.read()
+    profiling.count_bytes("bytes_read", template)
+    # The override of each layer, or None if the layer does not have one
+    overrides = []
+    for overrides_dir in overrides_dirs:
+        override = None
+        override_path = os.path.join(overrides_dir, template_path)
+        if override_path in override_paths:
+            with open(override_path, "rb") as o:
+                override = o.read()
+            profiling.count_bytes("bytes_read", override)
+        overrides.append(override)
+    return digest(output_format.value, additional_context, template, *overrides)
+
+
+def _read_merged(template: Tuple[str, List[str]], templates_dir) -> str:
+    template_path, override_paths = template
+    logging.debug(f"Processing {os.path.join(templates_dir, template_path)}")
+
+    with profiling.span(template_path, profiling.FILE, stage="merge"):
+        file_contents = ""
+        with open(os.path.join(templates_dir, template_path)) as t:
+            file_contents = t.read()
+        profiling.count_bytes("bytes_read", file_contents)
+
+        # Merge the contents of the templates with the overrides of all the layers at
+        # once
+        if override_paths:
+            overrides = []
+            for override_path in override_paths:
+                logging.info(f"Applying override at {override_path}")
+                with open(override_path) as o:
+                    overrides.append(o.read())
+                profiling.count_bytes("bytes_read", overrides[-1])
+            file_contents = merge_markdowns(file_contents, *overrides)
+    return file_contents
+
+
+def _merge_document(document: Tuple[str, str, List[str]]) -> str:
+    # Same as `_read_merged`, for a template and overrides already read into memory
+    path, text, overrides = document
+    with profiling.span(path, profiling.FILE, stage="merge"):
+        if overrides:
+            logging.info(f"Applying {len(overrides)} override(s) to {path}")
+            text = merge_markdowns(text, *overrides)
+    return text
@@ -0,0 +1,263 @@
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+from typing import Dict, Iterator, List
+from urllib.parse import urlparse
+
+# Categories of the spans
+STAGE = "stage"  # A step of the pipeline (eg: merge, substitute, publish)
+FILE = "file"  # The processing of a single file by a stage
+HTTP = "http"  # A request to Confluence
+
+
+class Collector:
+    """
+    Receives the timings and counters reported while the pipeline runs. Subclasses
+    override the hooks they need; the default hooks do nothing. Collectors are
+    registered with `add_collector`.
+
+    A span is a dictionary with the following keys:
+    - name: the name of the stage, the path of the file or the HTTP request
+    - category: one of {STAGE, FILE, HTTP}
+    - start: the start time, in seconds (see `time.perf_counter`)
+    - duration: the duration, in seconds
+    - pid, tid: the process and thread it ran in
+    - args: extra details (eg: the stage of a file, the status of a response)
+    """
+
+    def on_span(self, span: Dict) -> None:
+        pass
+
+    def on_count(self, name: str, value: int) -> None:
+        pass
+
+
+class Recorder(Collector):
+    """
+    Records the spans and counters as they are reported, to be replayed later (eg: in
+    the main process, for those reported in a worker process).
+    """
+
+    def __init__(self) -> None:
+        self.events = []  # ("span", span) or ("count", (name, value))
+
+    def on_span(self, span: Dict) -> None:
+        self.events.append(("span", span))
+
+    def on_count(self, name: str, value: int) -> None:
+        self.events.append(("count", (name, value)))
+
+
+class Profiler(Collector):
+    """
+    Aggregates the spans and counters into a summary (see `summary`) and keeps all
+    the spans, to be saved as a Chrome trace (see `save_trace`).
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.spans = []
+        self.counters = {}
+
+    def on_span(self, span: Dict) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+    def on_count(self, name: str, value: int) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self) -> Dict:
+        """
+        Returns the wall time of each stage, the time taken by each file in each stage,
+        the number and latencies of the HTTP requests (by method and path) and the
+        counters (eg: bytes read and written).
+        """
+        stages, files, http = {}, {}, {}
+        for span in self.spans:
+            if span["category"] == STAGE:
+                _add_timing(stages, span["name"], span["duration"])
+            elif span["category"] == FILE:
+                stage = files.setdefault(span["args"].get("stage", ""), {})
+                stage[span["name"]] = stage.get(span["name"], 0.0) + span["duration"]
+            elif span["category"] == HTTP:
+                _add_timing(http, span["name"], span["duration"])
+        return {
+            "stages": stages,
+            "files": files,
+            "http": http,
+            "counters": dict(self.counters),
+        }
+
+    def save_summary(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def save_trace(self, path: str) -> None:
+        """
+        Saves the spans in the Chrome trace event format, which can be opened with
+        chrome://tracing or https://ui.perfetto.dev.
+        """
+        start = min((span["start"] for span in self.spans), default=0.0)
+        events = [
+            {
+                "name": span["name"],
+                "cat": span["category"],
+                "ph": "X",
+                "ts": (span["start"] - start) * 1e6,
+                "dur": span["duration"] * 1e6,
+                "pid": span["pid"],
+                "tid": span["tid"],
+                "args": span["args"],
+            }
+            for span in self.spans
+        ]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+_collectors: List[Collector] = []
+
+
+def add_collector(collector: Collector) -> None:
+    """
+    Registers a collector, to receive the spans and counters reported from now on.
+    """
+    _collectors.append(collector)
+
+
+def remove_collector(collector: Collector) -> None:
+    _collectors.remove(collector)
+
+
+def collecting() -> bool:
+    """
+    Returns True if any collector is registered. Costly measurements should only be
+    taken in that case.
+    """
+    return bool(_collectors)
+
+
+@contextlib.contextmanager
+def collector(c: Collector) -> Iterator[Collector]:
+    """
+    Registers the collector for the duration of the context.
+    """
+    add_collector(c)
+    try:
+        yield c
+    finally:
+        remove_collector(c)
+
+
+@contextlib.contextmanager
+def recording() -> Iterator[Recorder]:
+    """
+    Reports the spans and counters to a new recorder only, for the duration of the
+    context (eg: in a worker process, which inherits the collectors of its parent).
+    """
+    global _collectors
+    collectors, _collectors = _collectors, []
+    recorder = Recorder()
+    add_collector(recorder)
+    try:
+        yield recorder
+    finally:
+        _collectors = collectors
+
+
+def replay(events: List) -> None:
+    """
+    Reports the events of a recorder to the registered collectors.
+    """
+    for kind, event in events:
+        if kind == "span":
+            for c in _collectors:
+                c.on_span(event)
+        else:
+            count(*event)
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = STAGE, **args) -> Iterator[None]:
+    """
+    Reports the time taken by the body of the context, if anything is collecting.
+    """
+    if not _collectors:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report_span(name, category, start, time.perf_counter() - start, **args)
+
+
+def report_span(
+    name: str, category: str, start: float, duration: float, **args
+) -> None:
+    """
+    Reports a span that has already been measured.
+    """
+    if not _collectors:
+        return
+    event = {
+        "name": name,
+        "category": category,
+        "start": start,
+        "duration": duration,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": args,
+    }
+    for c in _collectors:
+        c.on_span(event)
+
+
+def count(name: str, value: int = 1) -> None:
+    """
+    Adds the value to the counter with the given name.
+    """
+    for c in _collectors:
+        c.on_count(name, value)
+
+
+def count_bytes(name: str, data) -> None:
+    """
+    Adds the size of the given text (once encoded) or bytes to the counter.
+    """
+    if _collectors:
+        count(name, len(data.encode() if isinstance(data, str) else data))
+
+
+def http_response_hook(response, *args, **kwargs) -> None:
+    """
+    A requests response hook reporting each request to Confluence as an HTTP span, named
+    after its method and path (with the ids replaced by "{id}").
+    """
+    if not _collectors:
+        return
+    duration = response.elapsed.total_seconds()
+    path = re.sub(r"/\d+(?=/|$)", "/{id}", urlparse(response.request.url).path)
+    report_span(
+        f"{response.request.method} {path}",
+        HTTP,
+        time.perf_counter() - duration,
+        duration,
+        status=response.status_code,
+    )
+    count("http_requests")
+
+
+def _add_timing(timings: Dict, name: str, duration: float) -> None:
+    timing = timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+    timing["count"] += 1
+    timing["total"] += duration
+    timing["max"] = max(timing["max"], duration)
+    timing["mean"] = timing["total"] / timing["count"]
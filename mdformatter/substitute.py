@@ -1,15 +1,26 @@
+import functools
+import hashlib
 import logging
 import os
 import re
 
+from contextvars import ContextVar
 from enum import Enum
-from typing import Dict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
 from jinja2 import (
     BaseLoader,
     Environment,
+    FileSystemBytecodeCache,
     StrictUndefined,
+    Template,
 )
+from jinja2.runtime import Context
+
+from . import profiling
+from .documents import DocumentSet, read_documents, write_documents
+from .parallel import map_files
+from .partials import PartialsLoader
 
 
 class OutputFormat(Enum):
@@ -17,63 +28,455 @@ class OutputFormat(Enum):
     CONFLUENCE = "confluence"
 
 
+# A Gitbook tag: "{% ... %}", where "%" can only appear in the quoted arguments (eg:
+# `{% embed url="https://example.com/a%20b" %}`). The quoted arguments cannot span
+# several lines, nor contain "{%" or "%}". Tags whose quotes are not closed (eg:
+# `{% code title=Don't %}`) end with their first "%".
+GITBOOK_TAG_PATTERN = re.compile(
+    r"{% (?! %})(?:"
+    r"""[^%"']*(?:(?:"""
+    r'"[^"\n%{]*(?:(?:%(?!})|{(?!%))[^"\n%{]*)*"'
+    r"|'[^'\n%{]*(?:(?:%(?!})|{(?!%))[^'\n%{]*)*'"
+    r""")[^%"']*)*"""
+    r"|[^%]+"
+    r") %}"
+)
+# A Jinja statement that loads a partial by its name (eg: `{% include "support.md" %}`),
+# which the GITBOOK output format only keeps if the partial exists (see `prepare_text`)
+PARTIAL_TAG_PATTERN = re.compile(r"""{% (?:include|import|from)\s+(["'])([^"'\n]+)\1""")
+# A Jinja statement that defines a macro, which the GITBOOK output format only keeps in
+# the partials
+MACRO_TAG_PATTERN = re.compile(r"{% (?:macro|endmacro)\s")
+# The hyphen in the name of a Nunjucks tag (eg: "{% page-ref")
+NUNJUCKS_TAG_HYPHEN_PATTERN = re.compile(r"{\% ([a-z]*)-([a-z]*)")
+
+_environments = {}  # (OutputFormat, bytecode cache dir, partials dirs) -> Environment
+
+# The set of the names of the templates loaded while rendering, if they are recorded
+# (see `render_template`)
+_included_templates = ContextVar("_included_templates", default=None)
+
+
 def substitute_variables(
     markdowns_dir,
     input: Dict,
     output_format: OutputFormat,
     additional_context: Dict,
+    jobs: int = 1,
+    bytecode_cache_dir: Optional[str] = None,
 ) -> None:
-    for root, _dirs, files in os.walk(markdowns_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            logging.debug(f"Processing {file_path}")
-            updated_contents = ""
-            with open(file_path, "r") as f:
-                file_contents = f.read()
-                updated_contents = _substitute_variables(
-                    file_path, file_contents, input, output_format, additional_context
-                )
-            with open(file_path, "w") as f:
-                f.write(updated_contents)
-
-
-def _substitute_variables(
+    """
+    Substitutes the template variables of all the markdown files in the given directory,
+    in place. Files are processed independently of each other, using up to `jobs` worker
+    processes.
+    """
+    documents = read_documents(markdowns_dir)
+    write_documents(
+        substitute_documents(
+            documents,
+            input,
+            output_format,
+            additional_context,
+            jobs=jobs,
+            bytecode_cache_dir=bytecode_cache_dir,
+        ),
+        markdowns_dir,
+    )
+
+
+def substitute_documents(
+    documents: DocumentSet,
+    input: Dict,
+    output_format: OutputFormat,
+    additional_context: Dict,
+    jobs: int = 1,
+    paths: Optional[List[str]] = None,
+    referenced_variables: Optional[Dict[str, Set[str]]] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+    included_templates: Optional[Dict[str, Set[str]]] = None,
+) -> DocumentSet:
+    """
+    Substitutes the template variables of the documents in the given document set.
+    Documents are processed independently of each other, using up to `jobs` worker
+    processes.
+
+    Parameters
+    ----------
+    documents: DocumentSet
+        The merged (and for the CONFLUENCE output format, preprocessed) documents
+    input: Dict
+        The values to be applied to the variables in the documents
+    output_format: OutputFormat
+        The desired output format
+    additional_context: Dict
+        Extra values made available to the Gitbook tag extensions
+    jobs: int, default 1
+        The maximum number of worker processes to use
+    paths: List[str], optional
+        The paths of the documents to be substituted. Defaults to all the documents.
+        The other documents remain available to be referenced by the substituted ones.
+    referenced_variables: Dict[str, Set[str]], optional
+        If provided, the names of the variables referenced by each substituted document
+        are stored in it, by the document's path
+    bytecode_cache_dir: str, optional
+        Path to the folder where the compiled templates should be cached across runs
+    partials_dirs: Sequence[str], optional
+        The partials folder followed by its override folders, from which the templates
+        included or imported by the documents are loaded (see `PartialsLoader`)
+    included_templates: Dict[str, Set[str]], optional
+        If provided, the names of the templates loaded by each substituted document are
+        stored in it, by the document's path
+
+    Returns
+    -------
+    DocumentSet
+        The substituted documents
+    """
+    if paths is None:
+        paths = list(documents)
+
+    page_index = None
+    if output_format == OutputFormat.CONFLUENCE:
+        from .confluence.api import page_index as build_page_index
+        from .gitbooktags.confluence import check_page_references
+
+        # Resolve the pages that can be referenced once, and make sure that all the
+        # references can be resolved before rendering any of the documents.
+        page_index = build_page_index(documents)
+        check_page_references({path: documents[path] for path in paths}, page_index)
+
+    # Only the documents being substituted are handed to the workers
+    results = map_files(
+        functools.partial(
+            _substitute_document,
+            input=input,
+            output_format=output_format,
+            additional_context=additional_context,
+            page_index=page_index,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+        ),
+        [(path, documents[path]) for path in paths],
+        jobs=jobs,
+    )
+
+    substituted_documents = {}
+    for path, (text, variables, templates) in zip(paths, results):
+        substituted_documents[path] = text
+        if referenced_variables is not None:
+            referenced_variables[path] = variables
+        if included_templates is not None:
+            included_templates[path] = templates
+    return substituted_documents
+
+
+def _substitute_document(
+    document: Tuple[str, str],
+    input: Dict,
+    output_format: OutputFormat,
+    additional_context: Dict,
+    page_index: Optional[Dict[str, Tuple[str, str]]],
+    bytecode_cache_dir: Optional[str],
+    partials_dirs: Optional[Sequence[str]],
+) -> Tuple[str, Set[str], Set[str]]:
+    path, text = document
+    logging.debug(f"Processing {path}")
+    variables, templates = set(), set()
+    with profiling.span(path, profiling.FILE, stage="substitute"):
+        text = substitute_text(
+            path,
+            text,
+            input,
+            output_format,
+            additional_context,
+            referenced_variables=variables,
+            page_index=page_index,
+            bytecode_cache_dir=bytecode_cache_dir,
+            partials_dirs=partials_dirs,
+            included_templates=templates,
+        )
+    return text, variables, templates
+
+
+def substitute_text(
     file_path: str,
     text: str,
     input: Dict,
     output_format: OutputFormat,
     additional_context: Dict,
+    referenced_variables: Optional[Set[str]] = None,
+    page_index: Optional[Dict[str, Tuple[str, str]]] = None,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+    included_templates: Optional[Set[str]] = None,
+) -> str:
+    """
+    Returns the given markdown text with its template variables substituted and the
+    Gitbook tags converted to the desired output format.
+
+    Parameters
+    ----------
+    file_path: str
+        Path of the document the text belongs to, relative to the root folder of the
+        documents. Used to resolve relative page references.
+    text: str
+        The markdown text
+    input: Dict
+        The values to be applied to the variables in the text
+    output_format: OutputFormat
+        The desired output format
+    additional_context: Dict
+        Extra values made available to the Gitbook tag extensions
+    referenced_variables: Set[str], optional
+        If provided, the names of the variables looked up while rendering the text are
+        added to it
+    page_index: Dict[str, Tuple[str, str]], optional
+        Map of the path of each page that can be referenced by the text to its
+        Confluence page id and title. Required for resolving page references in the
+        CONFLUENCE output format.
+    bytecode_cache_dir: str, optional
+        Path to the folder where the compiled templates should be cached across runs
+    partials_dirs: Sequence[str], optional
+        The partials folder followed by its override folders, from which the templates
+        included or imported by the text are loaded (see `PartialsLoader`)
+    included_templates: Set[str], optional
+        If provided, the names of the templates loaded while rendering the text (eg:
+        included ones, and those they include) are added to it
+
+    Returns
+    -------
+    str
+        The rendered markdown text
+    """
+    return render_template(
+        compile_text(
+            text,
+            output_format,
+            bytecode_cache_dir,
+            partials_dirs,
+            included_templates=included_templates,
+        ),
+        file_path,
+        input,
+        additional_context,
+        referenced_variables=referenced_variables,
+        page_index=page_index,
+        included_templates=included_templates,
+    )
+
+
+def compile_text(
+    text: str,
+    output_format: OutputFormat,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+    included_templates: Optional[Set[str]] = None,
+) -> Template:
+    """
+    Compiles the given markdown text into a template for the desired output format, to
+    be rendered (see `render_template`) against any number of values. If provided, the
+    names of the partials that the text tries to load, whether they exist or not, are
+    added to `included_templates` (see `prepare_text`).
+    """
+    env = get_environment(output_format, bytecode_cache_dir, partials_dirs)
+    partials = env.loader if isinstance(env.loader, PartialsLoader) else None
+    token = _included_templates.set(included_templates)
+    try:
+        text = prepare_text(text, output_format, partials=partials)
+    finally:
+        _included_templates.reset(token)
+    return _compile_template(env, text)
+
+
+def prepare_text(
+    text: str,
+    output_format: OutputFormat,
+    partials: Optional[PartialsLoader] = None,
+    macros: bool = False,
 ) -> str:
-    extensions = []
+    """
+    Returns the given markdown text with its Gitbook tags rewritten so that it can be
+    parsed by the Jinja environment of the desired output format.
 
+    With the GITBOOK output format, the tags that include or import a template are
+    kept as Jinja statements only if the template is found among the given partials
+    (otherwise, eg: `{% include "../.gitbook/includes/support.md" %}`, they are
+    Gitbook tags), and the macro definitions only if `macros` is set (i.e., the text
+    is a partial).
+    """
     if output_format == OutputFormat.GITBOOK:
         # Wrap special tags with a "raw" Jinja tag so that subsequent processing with Jinja will
         # retain the tag.
-        text = re.sub(r"({\% [^%]+ \%})", "{% raw %}\g<0>{% endraw %}", text)
+        if partials is None:
+            text = GITBOOK_TAG_PATTERN.sub(r"{% raw %}\g<0>{% endraw %}", text)
+        else:
+            text = GITBOOK_TAG_PATTERN.sub(
+                functools.partial(_wrap_tag, partials=partials, macros=macros), text
+            )
     elif output_format == OutputFormat.CONFLUENCE:
-        from .gitbooktags.confluence import (
-            CodeTagExtension,
-            EmbedTagExtension,
-            HintTagExtension,
-            PageRefTagExtension,
+        # Remove hyphens from Nunjucks tags as Jinja cannot handle them
+        text = NUNJUCKS_TAG_HYPHEN_PATTERN.sub(r"{% \1\2", text)
+    return text
+
+
+def _wrap_tag(match: re.Match, partials: PartialsLoader, macros: bool) -> str:
+    tag = match.group(0)
+    if macros and MACRO_TAG_PATTERN.match(tag):
+        return tag
+    partial = PARTIAL_TAG_PATTERN.match(tag)
+    if partial is not None:
+        # Recorded even if it does not exist, so that the text is compiled again once
+        # it does (see `templates_digest`)
+        _record_name(partial.group(2))
+        if partials.exists(partial.group(2)):
+            return tag
+    return "{% raw %}" + tag + "{% endraw %}"
+
+
+def render_template(
+    tpl: Template,
+    file_path: str,
+    input: Dict,
+    additional_context: Dict,
+    referenced_variables: Optional[Set[str]] = None,
+    page_index: Optional[Dict[str, Tuple[str, str]]] = None,
+    included_templates: Optional[Set[str]] = None,
+) -> str:
+    """
+    Renders a template compiled with `compile_text`. See `substitute_text` for the
+    parameters.
+    """
+    token = _included_templates.set(included_templates)
+    try:
+        return tpl.render(
+            input,
+            file_path=file_path,
+            page_index=page_index,
+            additional_context=additional_context,
+            _referenced_variables=referenced_variables,
         )
+    finally:
+        _included_templates.reset(token)
+
+
+class _RecordingContext(Context):
+    """
+    A template context that records the names of the variables looked up while
+    rendering, in the set passed as the `_referenced_variables` variable (if any).
+    Templates included in the rendered one share the set, as they receive a copy of
+    the variables.
+    """
+
+    def resolve_or_missing(self, key: str):
+        referenced_variables = self.parent.get("_referenced_variables")
+        if referenced_variables is not None:
+            referenced_variables.add(key)
+        return super().resolve_or_missing(key)
+
+
+class _RecordingEnvironment(Environment):
+    """
+    An environment that records the names of the templates it loads while rendering
+    (eg: included or imported ones), in the set given to `render_template` (if any).
+    Unlike the variables (see `_RecordingContext`), these are not recorded through the
+    context, which imported templates do not receive.
+    """
 
-        extensions.extend(
-            [
+    def get_template(self, name, parent=None, globals=None) -> Template:
+        return _record_template(super().get_template(name, parent, globals))
+
+    def select_template(self, names, parent=None, globals=None) -> Template:
+        return _record_template(super().select_template(names, parent, globals))
+
+
+def _record_template(tpl: Template) -> Template:
+    if tpl.name is not None:
+        _record_name(tpl.name)
+    return tpl
+
+
+def _record_name(name: str) -> None:
+    included_templates = _included_templates.get()
+    if included_templates is not None:
+        included_templates.add(name)
+
+
+def get_environment(
+    output_format: OutputFormat,
+    bytecode_cache_dir: Optional[str] = None,
+    partials_dirs: Optional[Sequence[str]] = None,
+) -> Environment:
+    """
+    Returns the Jinja environment for the given output format. Environments are created
+    once per process and shared by all the documents, along with the templates they
+    load (see `PartialsLoader`), which are loaded again when their files change.
+
+    Parameters
+    ----------
+    output_format: OutputFormat
+        The desired output format
+    bytecode_cache_dir: str, optional
+        Path to the folder where the compiled templates should be cached across runs
+    partials_dirs: Sequence[str], optional
+        The partials folder followed by its override folders, from which the included
+        or imported templates are loaded. Without it, templates cannot be included.
+    """
+    if partials_dirs is not None:
+        partials_dirs = tuple(str(include_dir) for include_dir in partials_dirs)
+    key = (output_format, bytecode_cache_dir, partials_dirs)
+    if key not in _environments:
+        extensions = []
+        if output_format == OutputFormat.CONFLUENCE:
+            from .gitbooktags.confluence import (
                 CodeTagExtension,
                 EmbedTagExtension,
                 HintTagExtension,
                 PageRefTagExtension,
-            ]
+            )
+
+            extensions.extend(
+                [
+                    CodeTagExtension,
+                    EmbedTagExtension,
+                    HintTagExtension,
+                    PageRefTagExtension,
+                ]
+            )
+
+        bytecode_cache = None
+        if bytecode_cache_dir is not None:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(bytecode_cache_dir)
+
+        loader = BaseLoader()
+        if partials_dirs is not None:
+            loader = PartialsLoader(partials_dirs)
+            loader.prepare = functools.partial(
+                prepare_text, output_format=output_format, partials=loader, macros=True
+            )
+
+        env = _RecordingEnvironment(
+            extensions=extensions,
+            loader=loader,
+            undefined=StrictUndefined,
+            bytecode_cache=bytecode_cache,
+            auto_reload=True,
         )
-        # Remove hyphens from Nunjucks tags as Jinja cannot handle them
-        text = re.sub(r"{\% ([a-z]*)-([a-z]*)", r"{% \1\2", text)
+        env.context_class = _RecordingContext
+        _environments[key] = env
+    return _environments[key]
 
-    # Substitute variables
-    env = Environment(
-        extensions=extensions,
-        loader=BaseLoader,
-        undefined=StrictUndefined,
-    )
-    tpl = env.from_string(text)
-    return tpl.render(input, file_path=file_path, additional_context=additional_context)
+
+def _compile_template(env: Environment, text: str) -> Template:
+    # Templates created from strings bypass the bytecode cache of the environment, so the
+    # cache is looked up here, using the digest of the text as the key.
+    if env.bytecode_cache is None:
+        return env.from_string(text)
+
+    key = hashlib.sha256(text.encode()).hexdigest()
+    bucket = env.bytecode_cache.get_bucket(env, key, None, text)
+    if bucket.code is None:
+        bucket.code = env.compile(text)
+        env.bytecode_cache.set_bucket(bucket)
+    return env.template_class.from_code(env, bucket.code, env.make_globals(None))
@@ -0,0 +1,86 @@
+import logging
+import os
+import time
+
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# The state of a file: its modification time (in ns) and its size
+FileState = Tuple[int, int]
+
+
+def snapshot(paths: Iterable[str]) -> Dict[str, FileState]:
+    """
+    Returns the state of all the files at the given paths. Paths to directories are
+    walked recursively; missing paths are ignored.
+    """
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _dirs, names in os.walk(path):
+                for name in names:
+                    _add_file_state(files, os.path.join(root, name))
+        else:
+            _add_file_state(files, path)
+    return files
+
+
+def changed_paths(
+    before: Dict[str, FileState], after: Dict[str, FileState]
+) -> List[str]:
+    """
+    Returns the paths of the files that were added, modified or deleted between the two
+    snapshots.
+    """
+    return sorted(
+        path
+        for path in before.keys() | after.keys()
+        if before.get(path) != after.get(path)
+    )
+
+
+def watch(
+    paths: Iterable[str],
+    on_change: Callable[[List[str]], None],
+    interval: float = 0.25,
+) -> None:
+    """
+    Polls the files at the given paths every `interval` seconds and calls `on_change`
+    with the paths of the changed files, once they have stopped changing (eg: an editor
+    writing a file in several steps). Errors raised by `on_change` are logged and the
+    files are watched again. Returns when interrupted (Ctrl+C).
+    """
+    paths = list(paths)
+    state = snapshot(paths)
+    logging.info("Watching for changes ...")
+    try:
+        while True:
+            time.sleep(interval)
+            new_state = snapshot(paths)
+            if new_state == state:
+                continue
+
+            # Wait for the files to settle before rebuilding
+            while True:
+                time.sleep(interval)
+                settled_state = snapshot(paths)
+                if settled_state == new_state:
+                    break
+                new_state = settled_state
+
+            changed = changed_paths(state, new_state)
+            state = new_state
+            logging.info(f"Rebuilding after changes to {len(changed)} file(s) ...")
+            try:
+                on_change(changed)
+            except Exception as e:
+                logging.error(f"Build failed: {e!r}")
+    except KeyboardInterrupt:
+        logging.info("Stopped watching.")
+
+
+def _add_file_state(files: Dict[str, FileState], path: str) -> None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    files[path] = (stat.st_mtime_ns, stat.st_size)
@@ -0,0 +1,219 @@
+import hashlib
+
+import requests
+
+from md2conf.api import ConfluenceSession
+
+from benchmarks.fake_confluence import DOMAIN, PATH, SPACE, FakeConfluence
+from mdformatter.confluence.api import (
+    _get_page_ids,
+    _group_by_level,
+    parse_page_id,
+    preprocess,
+    publish,
+)
+from mdformatter.confluence.doctree import Node, build_tree
+
+
+def _page(title, parent_title=None):
+    text = f"<!-- page-title: {title} -->\n"
+    if parent_title is not None:
+        text += f"<!-- parent-page-title: {parent_title} -->\n"
+    return text + f"# {title}\n"
+
+
+def _session(fake):
+    session = requests.Session()
+    session.mount("https://", fake)
+    return ConfluenceSession(session, DOMAIN, PATH, SPACE)
+
+
+def _publish(fake, markdowns_dir, state_path, force=False):
+    # Publishes the markdowns to the fake and returns the (method, path) of the requests
+    # sent, sorted
+    fake.requests.clear()
+    publish(
+        str(markdowns_dir),
+        DOMAIN,
+        PATH,
+        SPACE,
+        None,
+        None,
+        state_path=state_path,
+        force=force,
+        session=_session(fake),
+    )
+    return sorted((method, path) for method, path, _ in fake.requests)
+
+
+def test_page_ids_are_listed_in_batches():
+    # The server returns fewer pages than requested
+    fake = FakeConfluence("Page 0", batch_size=2)
+    for i in range(1, 5):
+        fake.add_page(f"Page {i}")
+
+    page_ids = _get_page_ids(_session(fake))
+
+    assert page_ids == {f"Page {i}": str(i + 1) for i in range(5)}
+    assert [query["start"] for _, _, query in fake.requests] == ["0", "2", "4"]
+
+
+def test_pages_are_grouped_by_level_and_parent():
+    nodes = build_tree(
+        [
+            Node(id="Root", parent_id=None, rank=0),
+            Node(id="B1", parent_id="B", rank=0),
+            Node(id="A2", parent_id="A", rank=1),
+            Node(id="A", parent_id="Root", rank=0),
+            Node(id="A1", parent_id="A", rank=0),
+            Node(id="B", parent_id="Root", rank=1),
+        ]
+    )
+
+    levels = [
+        {
+            parent_id: [node.id for node in siblings]
+            for parent_id, siblings in level.items()
+        }
+        for level in _group_by_level(nodes)
+    ]
+
+    assert levels == [
+        {None: ["Root"]},
+        {"Root": ["A", "B"]},
+        {"A": ["A1", "A2"], "B": ["B1"]},
+    ]
+
+
+def test_missing_pages_are_created_concurrently_level_by_level():
+    documents = {
+        "a.md": _page("A"),
+        "a/a1.md": _page("A1", "A"),
+        "a/a2.md": _page("A2", "A"),
+        "b.md": _page("B"),
+        "c.md": _page("C"),
+        "d.md": _page("D"),
+    }
+    # Each page is created after its parent, or the fake fails to create it
+    fake = FakeConfluence("Root", latency=0.05)
+    fake.add_page("B", "1")
+
+    documents = preprocess(
+        documents,
+        DOMAIN,
+        PATH,
+        SPACE,
+        None,
+        None,
+        "Root",
+        confluence_workers=4,
+        session=_session(fake),
+    )
+
+    # The existing pages are not created again, and the siblings are created
+    # concurrently, even though they have the same parent
+    created = [page["title"] for page in list(fake.pages.values())[2:]]
+    assert sorted(created) == ["A", "A1", "A2", "C", "D"]
+    assert fake.max_active > 1
+
+    # The created pages are then ordered by rank, after the existing ones, whatever
+    # the order in which they were created
+    ids = {page["title"]: id for id, page in fake.pages.items()}
+    assert sorted(
+        path for method, path, _ in fake.requests if method == "PUT"
+    ) == sorted(
+        f"/content/{ids[title]}/move/after/{ids[previous_title]}"
+        for previous_title, title in [("A", "C"), ("C", "D"), ("A1", "A2")]
+    )
+
+    def children(title):
+        return [fake.pages[id]["title"] for id in fake.pages[ids[title]]["children"]]
+
+    assert children("Root") == ["B", "A", "C", "D"]
+    assert children("A") == ["A1", "A2"]
+
+    assert {path: parse_page_id(text) for path, text in documents.items()} == {
+        path: ids[title]
+        for path, title in [
+            ("a.md", "A"),
+            ("a/a1.md", "A1"),
+            ("a/a2.md", "A2"),
+            ("b.md", "B"),
+            ("c.md", "C"),
+            ("d.md", "D"),
+        ]
+    }
+
+
+def test_only_the_changed_pages_are_published(tmp_path):
+    markdowns_dir, state_path = tmp_path / "markdowns", str(tmp_path / "state.json")
+    markdowns_dir.mkdir()
+    for id, title in [("1", "A"), ("2", "B")]:
+        (markdowns_dir / f"{title.lower()}.md").write_text(
+            f"<!-- confluence-page-id: {id} -->\n{_page(title)}"
+        )
+    fake = FakeConfluence("A")
+    fake.add_page("B")
+
+    def publish_and_list_requests(force=False):
+        return _publish(fake, markdowns_dir, state_path, force=force)
+
+    publish_and_list_requests()
+    assert [page["version"] for page in fake.pages.values()] == [2, 2]
+
+    # Unchanged pages are skipped without any request, and get no new version
+    assert publish_and_list_requests() == []
+    (markdowns_dir / "b.md").write_text(
+        "<!-- confluence-page-id: 2 -->\n" + _page("B") + "Changed\n"
+    )
+    assert publish_and_list_requests() == [("GET", "/content/2"), ("PUT", "/content/2")]
+    assert [page["version"] for page in fake.pages.values()] == [2, 3]
+    assert publish_and_list_requests() == []
+
+    # Unless publishing is forced
+    assert publish_and_list_requests(force=True) == [
+        ("GET", "/content/1"),
+        ("GET", "/content/2"),
+    ]
+
+
+def test_only_the_changed_attachments_are_uploaded_once_per_page(tmp_path):
+    markdowns_dir, state_path = tmp_path / "markdowns", str(tmp_path / "state.json")
+    (markdowns_dir / "img").mkdir(parents=True)
+    (markdowns_dir / "img/logo.png").write_bytes(b"logo")
+    # Both pages reference the image, one of them twice
+    (markdowns_dir / "a.md").write_text(
+        "<!-- confluence-page-id: 1 -->\n"
+        + _page("A")
+        + "![Logo](img/logo.png)\n\n![Logo](img/logo.png)\n"
+    )
+    (markdowns_dir / "b.md").write_text(
+        "<!-- confluence-page-id: 2 -->\n" + _page("B") + "![Logo](img/logo.png)\n"
+    )
+    fake = FakeConfluence("A")
+    fake.add_page("B")
+
+    sent = _publish(fake, markdowns_dir, state_path)
+    assert [request for request in sent if request[0] == "POST"] == [
+        ("POST", "/content/1/child/attachment"),
+        ("POST", "/content/2/child/attachment"),
+    ]
+    assert [page["version"] for page in fake.pages.values()] == [2, 2]
+
+    # A page whose attachment changed gets no new version, if its content did not
+    uploads = sorted(
+        ("POST", f"/content/{page_id}/child/attachment/{attachment['id'][3:]}/data")
+        for (page_id, _), attachment in fake.attachments.items()
+    )
+    (markdowns_dir / "img/logo.png").write_bytes(b"new logo")
+    sent = _publish(fake, markdowns_dir, state_path)
+    assert [request for request in sent if request[0] == "POST"] == uploads
+    assert [page["version"] for page in fake.pages.values()] == [2, 2]
+
+    # Attachments already uploaded with the same digest (as recorded in their comment)
+    # are not uploaded again, even without the state
+    sent = _publish(fake, markdowns_dir, state_path, force=True)
+    assert [request for request in sent if request[0] == "POST"] == []
+    assert [
+        attachment["extensions"]["comment"] for attachment in fake.attachments.values()
+    ] == [f"sha256:{hashlib.sha256(b'new logo').hexdigest()}"] * 2
@@ -0,0 +1,57 @@
+import io
+import json
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from mdformatter.archives import read_archive
+from mdformatter.builder import build
+from mdformatter.documents import read_documents
+
+
+def test_build_from_and_to_archives(tmp_path):
+    with open("sample/input.json") as f:
+        values = json.load(f)
+    templates = str(tmp_path / "templates.tar.gz")
+    with tarfile.open(templates, "w:gz") as archive:
+        archive.add("sample/templates", arcname=".")
+    overrides = str(tmp_path / "overrides.zip")
+    with zipfile.ZipFile(overrides, "w") as archive:
+        for path in read_documents("sample/overrides"):
+            archive.write(os.path.join("sample/overrides", path), path)
+
+    for results in (str(tmp_path / "results.zip"), str(tmp_path / "results.tgz")):
+        assert build(templates, overrides, results, values) == {
+            "written": 3,
+            "unchanged": 0,
+            "removed": 0,
+        }
+        assert read_archive(results) == read_documents("sample/results_gitbook")
+
+        # An archive with the same members is not written again
+        with open(results, "rb") as f:
+            data = f.read()
+        mtime = os.stat(results).st_mtime_ns
+        assert build(templates, overrides, results, values)["unchanged"] == 3
+        assert os.stat(results).st_mtime_ns == mtime
+        with open(results, "rb") as f:
+            assert f.read() == data
+
+
+def test_members_outside_of_the_root_are_rejected(tmp_path):
+    for name in ("../x.md", "/abs/x.md", "dir/../../x.md"):
+        path = str(tmp_path / "templates.tar")
+        with tarfile.open(path, "w") as archive:
+            info = tarfile.TarInfo(name)
+            info.size = 1
+            archive.addfile(info, io.BytesIO(b"x"))
+        with pytest.raises(ValueError):
+            read_archive(path)
+
+        path = str(tmp_path / "templates.zip")
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr(name, "x")
+        with pytest.raises(ValueError):
+            read_archive(path)
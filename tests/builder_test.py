@@ -0,0 +1,31 @@
+import filecmp
+import json
+import os
+import subprocess
+import sys
+
+from mdformatter.pipeline import list_templates
+
+
+def test_gitbook_build_does_not_import_confluence(tmp_path):
+    results_dir = str(tmp_path / "results")
+    script = f"""
+import json, sys
+import mdformatter
+
+with open("sample/input.json") as f:
+    values = json.load(f)
+mdformatter.build("sample/templates", "sample/overrides", {results_dir!r}, values)
+print(json.dumps([m for m in ("md2conf", "requests") if m in sys.modules]))
+"""
+    output = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout
+    assert json.loads(output) == []
+
+    for path in list_templates("sample/templates"):
+        assert filecmp.cmp(
+            os.path.join(results_dir, path),
+            os.path.join("sample/results_gitbook", path),
+            shallow=False,
+        ), path
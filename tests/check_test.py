@@ -0,0 +1,35 @@
+import json
+
+from mdformatter.builder import check
+from mdformatter.check import check_documents
+from mdformatter.substitute import OutputFormat
+
+DOCUMENTS = {
+    "a.md": "# A\n\n{{ known }} {{ missing }} {{ optional | default('x') }}\n",
+    "b/c.md": '# C\n\n{% tabs %}\n{% page-ref page="../a.md" %}\n'
+    '{% page-ref page="d.md" %}\n{{ missing }}\n',
+}
+
+
+def test_sample_has_no_problems():
+    with open("sample/input.json") as f:
+        inputs = {"input": json.load(f)}
+    for output_format in (OutputFormat.GITBOOK, OutputFormat.CONFLUENCE):
+        assert (
+            check("sample/templates", "sample/overrides", inputs, output_format) == []
+        )
+
+
+def test_check_documents_reports_all_problems():
+    inputs = {"values": {"known": 1}}
+    assert check_documents(DOCUMENTS, inputs, OutputFormat.GITBOOK, jobs=2) == [
+        "a.md:3: 'missing' is undefined",
+        "b/c.md:5: Referenced page not found: b/d.md",
+        "b/c.md:6: 'missing' is undefined",
+    ]
+    # Unknown tags do not prevent the rest of the document from being checked
+    assert check_documents(DOCUMENTS, inputs, OutputFormat.CONFLUENCE)[1:] == [
+        "b/c.md:3: Unknown tag 'tabs'",
+        "b/c.md:5: Referenced page not found: b/d.md",
+        "b/c.md:6: 'missing' is undefined",
+    ]
@@ -0,0 +1,35 @@
+import pytest
+
+from mdformatter.confluence.doctree import DEPTH, Node, TreeError, build_tree
+
+
+def _ids(nodes):
+    return [node.id for node in nodes]
+
+
+def test_build_tree_orders_siblings_by_rank():
+    nodes = [
+        Node(id="root", parent_id=None, rank=0),
+        Node(id="a", parent_id="root", rank=1),
+        Node(id="b", parent_id="root", rank=0),
+        Node(id="c", parent_id="a", rank=0),
+        Node(id="d", parent_id="b", rank=0),
+        Node(id="e", parent_id="a", rank=0),
+    ]
+
+    assert _ids(build_tree(nodes)) == ["root", "b", "a", "d", "c", "e"]
+    assert _ids(build_tree(nodes, sorting=DEPTH)) == ["root", "b", "d", "a", "c", "e"]
+
+
+def test_build_tree_reports_orphaned_and_cyclic_pages():
+    nodes = [
+        Node(id="root", parent_id=None, rank=0),
+        Node(id="orphan", parent_id="missing", rank=0),
+        Node(id="a", parent_id="b", rank=0),
+        Node(id="b", parent_id="a", rank=0),
+    ]
+
+    with pytest.raises(TreeError) as err:
+        build_tree(nodes)
+    assert "orphan (missing: missing)" in str(err.value)
+    assert "['a', 'b']" in str(err.value)
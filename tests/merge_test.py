@@ -1,6 +1,7 @@
 import difflib
+import io
 
-from mdformatter.merge import merge_markdowns
+from mdformatter.merge import merge_markdown_contents, merge_markdowns, parse_markdown
 
 
 def test_merge_markdowns_identity():
@@ -18,6 +19,91 @@ def test_merge_markdowns_identity():
     assert base == merged
 
 
+def test_merge_markdowns_ignores_headings_in_code_blocks():
+    base = "# Install\n\n```sh\n# Download\ncurl x\n```\n\n# Usage\n\nRun it."
+    override = "# Usage\n\nRun it twice."
+
+    merged = merge_markdowns(base, override)
+
+    assert merged == base.replace("Run it.", "Run it twice.")
+
+
+def test_merge_markdowns_streams_same_text():
+    with open("sample/templates/dir/basic/candy.md") as f:
+        base = f.read()
+    with open("sample/overrides/dir/basic/candy.md") as f:
+        override = f.read()
+
+    fp = io.StringIO()
+    merge_markdown_contents(base, override).write_to(fp)
+
+    assert fp.getvalue() == merge_markdowns(base, override)
+
+
+def test_merge_markdowns_layers():
+    base = "# A\n\nbase a\n\n## B\n\nbase b\n\n# C\n\nbase c"
+    org = "# A\n\n## B\n\norg b\n\n# D\n\norg d"
+    team = "# C\n\nteam c\n\n# D\n\nteam d\n\n## E\n\nteam e"
+
+    merged = merge_markdowns(base, org, team)
+
+    assert merged == merge_markdowns(merge_markdowns(base, org), team)
+    assert "org b" in merged and "team c" in merged and "team d" in merged
+
+
+def test_parsed_sections_refer_to_the_source():
+    text = "intro\n# A\n\na1\n## B\nb\n"
+
+    parsed = parse_markdown(text)
+    section_a = parsed.subsections["# A"]
+    section_b = section_a.subsections["## B"]
+
+    # The sections keep the offsets of their lines in the source, without copying them
+    assert not hasattr(parsed, "__dict__")
+    assert all(section.source is text for section in (parsed, section_a, section_b))
+    assert [parsed.span, section_a.span, section_b.span] == [(0, 5), (10, 13), (19, 21)]
+    assert [parsed.lines, section_a.lines, section_b.lines] == [
+        ["intro"],
+        ["", "a1"],
+        ["b", ""],
+    ]
+
+
+def test_parsed_sections_keep_carriage_returns_and_missing_final_newline():
+    text = "# A\r\n\r\na\r\n# B\r\nb"
+
+    parsed = parse_markdown(text)
+
+    assert parsed.span is None
+    assert parsed.subsections["# A\r"].lines == ["\r", "a\r"]
+    assert parsed.subsections["# B\r"].lines == ["b"]
+    assert parsed.to_text() == text
+
+
+def test_setting_lines_replaces_only_that_section():
+    text = "# A\n\na\n\n# B\n\nb"
+    parsed = parse_markdown(text)
+
+    parsed.subsections["# A"].lines = ["", "new a", ""]
+
+    assert parsed.to_text() == "# A\n\nnew a\n\n# B\n\nb"
+    assert parsed.subsections["# B"].source is text
+    parsed.subsections["# B"].lines = []
+    assert parsed.subsections["# B"].lines == []
+    assert parsed.to_text() == "# A\n\nnew a\n\n# B\n"
+
+
+def test_sections_with_only_empty_lines_or_subsections_have_no_lines():
+    parsed = parse_markdown("# A\n\n\n# B\n## C\nc")
+
+    assert not parsed.has_lines() and parsed.lines == []
+    assert not parsed.subsections["# A"].has_lines()
+    assert parsed.subsections["# A"].lines == ["", ""]
+    assert not parsed.subsections["# B"].has_lines()
+    assert parsed.subsections["# B"].lines == []
+    assert parsed.subsections["# B"].subsections["## C"].has_lines()
+
+
 def _unidiff_output(expected, actual):
     """
     Helper function. Returns a string containing the unified diff of two multiline strings.
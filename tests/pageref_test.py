@@ -0,0 +1,47 @@
+import pytest
+
+from md2conf.converter import DocumentError
+
+from mdformatter.substitute import OutputFormat, substitute_documents
+
+ADDITIONAL_CONTEXT = {
+    "confluence_domain": "example.atlassian.net",
+    "confluence_path": "/wiki/",
+    "confluence_space": "DOCS",
+}
+
+
+def _page(page_id, title, body=""):
+    return (
+        f"<!-- confluence-page-id: {page_id} -->\n<!-- page-title: {title} -->\n{body}"
+    )
+
+
+def test_page_refs_are_resolved_from_page_index():
+    documents = {
+        "index.md": _page(1, "Index", '{% page-ref page="./dir/page.md" %}'),
+        "dir/page.md": _page(2, "Page", '{% page-ref page="../index.md" %}'),
+    }
+
+    results = substitute_documents(
+        documents, {}, OutputFormat.CONFLUENCE, ADDITIONAL_CONTEXT
+    )
+
+    assert results["index.md"].endswith(
+        "[Page](https://example.atlassian.net/wiki/spaces/DOCS/pages/2)"
+    )
+    assert results["dir/page.md"].endswith(
+        "[Index](https://example.atlassian.net/wiki/spaces/DOCS/pages/1)"
+    )
+
+
+def test_all_missing_page_refs_are_reported():
+    documents = {
+        "index.md": _page(1, "Index", '{% page-ref page="./missing.md" %}'),
+        "page.md": _page(2, "Page", '{% page-ref page="./gone.md" %}'),
+    }
+
+    with pytest.raises(DocumentError) as err:
+        substitute_documents(documents, {}, OutputFormat.CONFLUENCE, ADDITIONAL_CONTEXT)
+    assert "index.md -> missing.md" in str(err.value)
+    assert "page.md -> gone.md" in str(err.value)
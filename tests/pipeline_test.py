@@ -0,0 +1,184 @@
+import filecmp
+import json
+import os
+
+from mdformatter.manifest import Manifest, manifest_path
+from mdformatter.pipeline import (
+    format_templates,
+    list_templates,
+    load_documents,
+    render_documents,
+    render_variants,
+)
+from mdformatter.substitute import OutputFormat
+
+
+def test_format_templates_parallel_matches_serial(tmp_path):
+    with open("sample/input.json") as f:
+        values = json.load(f)
+
+    for jobs in (1, 2):
+        results_dir = str(tmp_path / f"results_{jobs}")
+        format_templates(
+            "sample/templates",
+            "sample/overrides",
+            results_dir,
+            values,
+            OutputFormat.GITBOOK,
+            additional_context={},
+            jobs=jobs,
+        )
+
+        for path in list_templates("sample/templates"):
+            assert filecmp.cmp(
+                os.path.join(results_dir, path),
+                os.path.join("sample/results_gitbook", path),
+                shallow=False,
+            ), path
+
+
+def test_format_templates_skips_up_to_date_files(tmp_path):
+    results_dir = str(tmp_path / "results")
+    manifest = Manifest(manifest_path(str(tmp_path / "cache"), results_dir))
+    values = {"caramel_boiling_point": "1", "caramel_final_temperature": "2"}
+
+    def format_and_stat():
+        format_templates(
+            "sample/templates",
+            "sample/overrides",
+            results_dir,
+            values,
+            OutputFormat.GITBOOK,
+            additional_context={},
+            manifest=Manifest.load(manifest.path),
+        )
+        return {
+            path: os.stat(os.path.join(results_dir, path)).st_mtime_ns
+            for path in list_templates("sample/templates")
+        }
+
+    first = format_and_stat()
+    assert format_and_stat() == first
+
+    # Only the file referencing the value should be rebuilt
+    values["caramel_final_temperature"] = "3"
+    third = format_and_stat()
+    assert third["dir/basic.md"] == first["dir/basic.md"]
+    with open(os.path.join(results_dir, "dir/basic/candy.md")) as f:
+        assert "heated beyond 3." in f.read()
+
+
+def test_render_variants_matches_render_documents(tmp_path):
+    with open("sample/input.json") as f:
+        values = json.load(f)
+    other_values = dict(values, caramel_final_temperature="3")
+    documents = load_documents("sample/templates", "sample/overrides")
+
+    render_variants(
+        documents,
+        str(tmp_path / "variants"),
+        {"default": values, "other": other_values},
+        OutputFormat.GITBOOK,
+        additional_context={},
+        jobs=2,
+    )
+
+    for name, input in (("default", values), ("other", other_values)):
+        results_dir = str(tmp_path / name)
+        render_documents(
+            documents, results_dir, input, OutputFormat.GITBOOK, additional_context={}
+        )
+        for path in documents:
+            assert filecmp.cmp(
+                os.path.join(tmp_path, "variants", name, path),
+                os.path.join(results_dir, path),
+                shallow=False,
+            ), path
+
+
+def test_format_templates_writes_only_changed_files(tmp_path):
+    results_dir = str(tmp_path / "results")
+    values = {"caramel_boiling_point": "1", "caramel_final_temperature": "2"}
+
+    def format_and_stat():
+        results = format_templates(
+            "sample/templates",
+            "sample/overrides",
+            results_dir,
+            values,
+            OutputFormat.GITBOOK,
+            additional_context={},
+        )
+        mtimes = {
+            path: os.stat(os.path.join(results_dir, path)).st_mtime_ns
+            for path in list_templates("sample/templates")
+        }
+        return results, mtimes
+
+    results, first = format_and_stat()
+    assert results == {"written": 3, "unchanged": 0, "removed": 0}
+
+    # Without a manifest, all the files are rendered but none is written again
+    results, second = format_and_stat()
+    assert results == {"written": 0, "unchanged": 3, "removed": 0}
+    assert second == first
+    assert sorted(os.listdir(os.path.join(results_dir, "dir"))) == [
+        "basic",
+        "basic.md",
+    ]
+
+    values["caramel_final_temperature"] = "3"
+    results, third = format_and_stat()
+    assert results == {"written": 1, "unchanged": 2, "removed": 0}
+    assert third["dir/basic.md"] == first["dir/basic.md"]
+
+
+def test_included_partials_are_merged_and_tracked(tmp_path):
+    templates_dir, overrides_dir = tmp_path / "templates", tmp_path / "overrides"
+    partials_dir, partial_overrides_dir = tmp_path / "partials", tmp_path / "layer"
+    for path in (templates_dir, overrides_dir, partials_dir, partial_overrides_dir):
+        path.mkdir()
+    (templates_dir / "page.md").write_text(
+        '# Page\n\n{% hint style="info" %}\n{% include "support.md" %}\n'
+        '{% endhint %}\n{% include "../.gitbook/includes/faq.md" %}\n'
+    )
+    (templates_dir / "other.md").write_text('# Other\n\n{% include "later.md" %}\n')
+    (partials_dir / "support.md").write_text("## Support\n\nAsk {{ team }}\n")
+    (partial_overrides_dir / "support.md").write_text("## Support\n\nAsk us\n")
+    results_dir = str(tmp_path / "results")
+    manifest = Manifest(manifest_path(str(tmp_path / "cache"), results_dir))
+
+    def format():
+        return format_templates(
+            str(templates_dir),
+            str(overrides_dir),
+            results_dir,
+            {},
+            OutputFormat.GITBOOK,
+            additional_context={},
+            manifest=Manifest.load(manifest.path),
+            partials_dirs=[str(partials_dir), str(partial_overrides_dir)],
+        )
+
+    # The partials are not rendered on their own, and the Gitbook includes (whose
+    # template is not among the partials) are kept as they are
+    format()
+    assert sorted(os.listdir(results_dir)) == ["other.md", "page.md"]
+    with open(os.path.join(results_dir, "page.md")) as f:
+        assert f.read() == (
+            '# Page\n\n{% hint style="info" %}\n## Support\n\nAsk us\n{% endhint %}\n'
+            '{% include "../.gitbook/includes/faq.md" %}'
+        )
+    with open(os.path.join(results_dir, "other.md")) as f:
+        assert f.read() == '# Other\n\n{% include "later.md" %}'
+    assert Manifest.load(manifest.path).dependents("support.md") == ["page.md"]
+
+    # Only the pages including a partial are built again when it changes, or once it
+    # exists
+    (partial_overrides_dir / "support.md").write_text("## Support\n\nAsk them\n")
+    assert format() == {"written": 1, "unchanged": 1, "removed": 0}
+    (partials_dir / "later.md").write_text("Later")
+    assert format() == {"written": 1, "unchanged": 1, "removed": 0}
+    with open(os.path.join(results_dir, "other.md")) as f:
+        assert f.read() == "# Other\n\nLater"
+    assert format() == {"written": 0, "unchanged": 2, "removed": 0}
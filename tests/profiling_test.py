@@ -0,0 +1,29 @@
+import json
+
+from mdformatter import profiling
+from mdformatter.pipeline import format_templates, list_templates
+from mdformatter.substitute import OutputFormat
+
+
+def test_profiler_collects_file_timings_from_workers(tmp_path):
+    with open("sample/input.json") as f:
+        values = json.load(f)
+
+    with profiling.collector(profiling.Profiler()) as profiler:
+        with profiling.span("format"):
+            format_templates(
+                "sample/templates",
+                "sample/overrides",
+                str(tmp_path / "results"),
+                values,
+                OutputFormat.GITBOOK,
+                additional_context={},
+                jobs=2,
+            )
+    summary = profiler.summary()
+
+    assert summary["stages"]["format"]["count"] == 1
+    assert set(summary["files"]["format"]) == set(list_templates("sample/templates"))
+    assert summary["counters"]["bytes_read"] > 0
+    assert summary["counters"]["bytes_written"] > 0
+    assert not profiling.collecting()
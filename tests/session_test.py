@@ -0,0 +1,86 @@
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from mdformatter import profiling
+from mdformatter.confluence.session import RETRY_STATUSES, ConfluenceRetry
+
+
+@pytest.fixture
+def server():
+    # Responds to each request with the next status of the server's list (None to drop
+    # the connection), and 200 once the list is exhausted
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            status = self.server.statuses.pop(0) if self.server.statuses else 200
+            self.server.requests += 1
+            if status is None:
+                # Drop the connection without responding
+                self.close_connection = True
+                return
+            self.send_response(status)
+            if status == 429:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.statuses, server.requests = [], 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def _session():
+    session = requests.Session()
+    retry = ConfluenceRetry(
+        total=3,
+        status_forcelist=RETRY_STATUSES,
+        raise_on_status=False,
+    )
+    session.mount("http://", HTTPAdapter(max_retries=retry))
+    return session
+
+
+def test_throttled_requests_are_retried(server):
+    server.statuses = [429, 503]
+    url = f"http://127.0.0.1:{server.server_port}/content"
+
+    with profiling.collector(profiling.Profiler()) as profiler:
+        response = _session().get(url)
+
+    assert response.status_code == 200
+    assert server.requests == 3
+    assert profiler.counters["http_retries"] == 2
+
+
+def test_failed_page_creations_are_not_retried(server):
+    server.statuses = [500, 429]
+    url = f"http://127.0.0.1:{server.server_port}/content"
+
+    assert _session().post(url).status_code == 500
+    assert server.requests == 1
+
+
+def test_dropped_page_creations_are_not_retried(server):
+    server.statuses = [None, None]
+    url = f"http://127.0.0.1:{server.server_port}/content"
+
+    with pytest.raises(requests.ConnectionError):
+        _session().post(url)
+    assert server.requests == 1
+
+    # Unlike idempotent requests
+    server.statuses = [None]
+    assert _session().get(url).status_code == 200
+    assert server.requests == 3
@@ -0,0 +1,91 @@
+import os
+import re
+
+from jinja2 import Environment
+
+from mdformatter.substitute import (
+    OutputFormat,
+    get_environment,
+    prepare_text,
+    substitute_text,
+)
+
+# The regular expressions previously used by `prepare_text`
+PREVIOUS_PREPARE = {
+    OutputFormat.GITBOOK: lambda text: re.sub(
+        r"({\% [^%]+ \%})", r"{% raw %}\g<0>{% endraw %}", text
+    ),
+    OutputFormat.CONFLUENCE: lambda text: re.sub(
+        r"{\% ([a-z]*)-([a-z]*)", r"{% \1\2", text
+    ),
+}
+
+
+def test_tags_are_prepared_as_with_regular_expressions():
+    text = (
+        '# Title\n{% hint style="info" %}\nNote {{ x }}\n{% endhint %}\n'
+        '{% tabs %}{% tab title="Python" %}{% endtab %}{% endtabs %}\n'
+        '{% page-ref page="./a-b.md" %}{% content-ref url="x" %}{% endcontent-ref %}\n'
+        "{%- if x %}{% endif %}{%  %}{%   %}{% a %b %}{% a-b-c %}{% -a %}\n"
+        "{% hint style='it\"s' %}{% code title=Don't %}\n{% tab title=\"a\nb\" %}\n"
+        '{% "{% x " %}{% a "b %} c " d %}'
+    )
+
+    for output_format, previous_prepare in PREVIOUS_PREPARE.items():
+        assert prepare_text(text, output_format) == previous_prepare(text)
+
+
+def test_percent_signs_in_quoted_arguments_are_kept():
+    text = (
+        '{% embed url="https://example.com/a%20b" %}\n'
+        "{% file src='100%.pdf' caption=\"{{ x }}\" %}\n"
+        "{{ x }}"
+    )
+
+    result = substitute_text("index.md", text, {"x": 1}, OutputFormat.GITBOOK, {})
+
+    assert result == text[: -len("{{ x }}")] + "1"
+
+
+def test_environments_are_shared(tmp_path):
+    cache_dir, partials_dir = str(tmp_path / "bytecode"), str(tmp_path / "partials")
+
+    env = get_environment(OutputFormat.GITBOOK, cache_dir, [partials_dir])
+
+    assert get_environment(OutputFormat.GITBOOK, cache_dir, (partials_dir,)) is env
+    assert get_environment(OutputFormat.GITBOOK, cache_dir) is not env
+    assert (
+        get_environment(OutputFormat.CONFLUENCE, cache_dir, [partials_dir]) is not env
+    )
+
+
+def test_compiled_templates_are_loaded_from_the_bytecode_cache(tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "bytecode")
+    compiled = []
+    compile = Environment.compile
+
+    def compile_and_count(self, *args, **kwargs):
+        compiled.append(args[0])
+        return compile(self, *args, **kwargs)
+
+    monkeypatch.setattr(Environment, "compile", compile_and_count)
+
+    def substitute(x):
+        return substitute_text(
+            "index.md",
+            "# {{ x }}",
+            {"x": x},
+            OutputFormat.GITBOOK,
+            {},
+            bytecode_cache_dir=cache_dir,
+        )
+
+    assert substitute(1) == "# 1"
+    assert len(compiled) == 1
+    cache_files = os.listdir(cache_dir)
+    assert len(cache_files) == 1
+
+    # The same text is not compiled again, even with other values
+    assert substitute(2) == "# 2"
+    assert len(compiled) == 1
+    assert os.listdir(cache_dir) == cache_files
@@ -0,0 +1,128 @@
+import json
+import os
+
+from benchmarks.fake_confluence import (
+    DOMAIN,
+    PATH,
+    ROOT_PAGE,
+    SPACE,
+    FakeConfluence,
+    serve,
+)
+from mdformatter import __main__
+from mdformatter.watch import changed_paths, snapshot
+
+
+def test_changed_paths(tmp_path):
+    for name in ("a.md", "b.md", "c.md"):
+        (tmp_path / name).write_text(name)
+    before = snapshot([str(tmp_path)])
+
+    (tmp_path / "a.md").write_text("changed a.md")
+    (tmp_path / "b.md").unlink()
+    (tmp_path / "d.md").write_text("d.md")
+
+    assert changed_paths(before, snapshot([str(tmp_path)])) == [
+        os.path.join(str(tmp_path), name) for name in ("a.md", "b.md", "d.md")
+    ]
+
+
+def _watch(monkeypatch, argv):
+    # Builds as `python -m mdformatter --watch` would, and returns the function called
+    # with the changed files, instead of polling them
+    rebuilds = []
+    monkeypatch.setattr(
+        __main__, "watch", lambda paths, on_change: rebuilds.append(on_change)
+    )
+    __main__.main(argv + ["--watch"])
+    return rebuilds[0]
+
+
+def _written_files(results_dir):
+    # The names of the results written since the last call, which resets their
+    # modification times
+    written = []
+    for name in sorted(os.listdir(results_dir)):
+        path = os.path.join(results_dir, name)
+        if os.stat(path).st_mtime_ns != 0:
+            written.append(name)
+            os.utime(path, ns=(0, 0))
+    return written
+
+
+def test_rebuild_renders_only_the_affected_files(tmp_path, monkeypatch):
+    templates_dir, overrides_dir = tmp_path / "templates", tmp_path / "overrides"
+    templates_dir.mkdir()
+    overrides_dir.mkdir()
+    (templates_dir / "x.md").write_text("# X\n\n{{ x }}")
+    (templates_dir / "y.md").write_text("# Y\n\n{{ y }}")
+    values_path = tmp_path / "values.json"
+    values_path.write_text(json.dumps({"x": 1, "y": 1}))
+    results_dir = str(tmp_path / "results")
+
+    rebuild = _watch(
+        monkeypatch,
+        [
+            str(templates_dir),
+            str(overrides_dir),
+            results_dir,
+            str(values_path),
+            "GITBOOK",
+            "--cache-dir",
+            str(tmp_path / "cache"),
+        ],
+    )
+    assert _written_files(results_dir) == ["x.md", "y.md"]
+
+    # Only the results reading the changed value are written again
+    values_path.write_text(json.dumps({"x": 1, "y": 2}))
+    rebuild([str(values_path)])
+    assert _written_files(results_dir) == ["y.md"]
+
+    # Editing a template leaves the results of the other templates untouched
+    (templates_dir / "x.md").write_text("# X\n\nx = {{ x }}")
+    rebuild([str(templates_dir / "x.md")])
+    assert _written_files(results_dir) == ["x.md"]
+
+
+def test_rebuild_renders_the_pages_referencing_a_renamed_page(tmp_path, monkeypatch):
+    templates_dir, overrides_dir = tmp_path / "templates", tmp_path / "overrides"
+    templates_dir.mkdir()
+    overrides_dir.mkdir()
+    (templates_dir / "a.md").write_text(
+        '<!-- page-title: A -->\n# A\n\n{% page-ref page="./b.md" %}\n'
+    )
+    (templates_dir / "b.md").write_text("<!-- page-title: B -->\n# B\n")
+    (templates_dir / "c.md").write_text("<!-- page-title: C -->\n# C\n")
+    values_path = tmp_path / "values.json"
+    values_path.write_text("{}")
+    results_dir = str(tmp_path / "results")
+
+    with serve(FakeConfluence()):
+        rebuild = _watch(
+            monkeypatch,
+            [
+                str(templates_dir),
+                str(overrides_dir),
+                results_dir,
+                str(values_path),
+                "CONFLUENCE",
+                "--cache-dir",
+                str(tmp_path / "cache"),
+                f"--domain={DOMAIN}",
+                f"--path={PATH}",
+                f"--space={SPACE}",
+                "--username=user",
+                "--apikey=key",
+                f"--rootpage={ROOT_PAGE}",
+            ],
+        )
+        assert _written_files(results_dir) == ["a.md", "b.md", "c.md"]
+
+        # The page referencing the renamed page is written again, with its new title
+        (templates_dir / "b.md").write_text("<!-- page-title: New B -->\n# B\n")
+        rebuild([str(templates_dir / "b.md")])
+
+    assert _written_files(results_dir) == ["a.md", "b.md"]
+    with open(os.path.join(results_dir, "a.md")) as f:
+        assert "New B" in f.read()